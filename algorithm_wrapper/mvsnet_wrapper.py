@@ -4,7 +4,10 @@ import os
 import pathlib
 import logging
 import subprocess
-from third_party.colmap.read_write_model import read_model, write_model
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from pipeline.colmap_model import ColmapModel
 from pipeline.common_options import GLOBAL_OPTIONS as FLAGS
 
 
@@ -37,25 +40,137 @@ def get_mvsnet_options():
     return mvsnet_options
 
 
-def export_colmap_to_mvsnet(output_dir):
-    if os.path.exists(os.path.join(output_dir, 'sparse/cameras.txt')) is False:
-        sparse_dir = os.path.join(output_dir, 'sparse')
-        write_model(*read_model(sparse_dir, '.bin'), sparse_dir, '.txt')
-    exlude_images = list(pathlib.Path(os.path.join(output_dir, 'images')).iterdir())
+# colmap2mvsnet.py defaults
+MVSNET_DEFAULT_MAX_D = 192
+MVSNET_DEFAULT_INTERVAL_SCALE = 1.
+# undistorted images with these suffixes are renamed to images/%08d.jpg as they are, the others transcoded
+JPEG_EXTENSIONS = ['.jpg', '.jpeg']
+
+
+def mvsnet_depth_ranges(model, max_d=None, interval_scale=MVSNET_DEFAULT_INTERVAL_SCALE):
+    """(depth_min, depth_interval, depth_num, depth_max) of every image row, (N, 4).
+
+    Same rule as colmap2mvsnet.py: depth_min / depth_max are the 1% / 99%
+    depths of the sparse points seen by the image times 0.75 / 1.25; with
+    max_d == 0 depth_num is chosen so that a depth step at depth_min moves
+    by about one pixel at the principal point, otherwise it is max_d.
+    """
+    max_d = MVSNET_DEFAULT_MAX_D if max_d is None else max_d
+    images_arrays = model.images_arrays
+    poses = model.poses
+    image_rows = np.repeat(np.arange(model.num_images), np.diff(images_arrays.point2D_offsets))
+    point_rows = model.point3D_rows(images_arrays.point3D_ids)
+    valid = (images_arrays.point3D_ids != -1) & (point_rows >= 0)
+    image_rows, point_rows = image_rows[valid], point_rows[valid]
+    depths = np.einsum('nj,nj->n', poses.R[image_rows, 2], model.points3D_arrays.xyzs[point_rows]) \
+        + poses.t[image_rows, 2]
+    depths = depths[np.lexsort((depths, image_rows))]
+
+    counts = np.bincount(image_rows, minlength=model.num_images)
+    if not np.all(counts > 0):
+        logging.critical('images without sparse points: %s',
+                         [images_arrays.names[row] for row in np.flatnonzero(counts == 0).tolist()])
+        exit(1)
+    starts = np.cumsum(counts) - counts
+    depth_min = depths[starts + (counts * .01).astype(np.int64)] * 0.75
+    depth_max = depths[starts + (counts * .99).astype(np.int64)] * 1.25
+    if max_d == 0:
+        # a one pixel step along x at the principal point is |depth_min| / fx away at depth_min
+        fx = model.camera_matrices()[model.image_camera_rows(), 0, 0]
+        depth_num = (1 / depth_min - 1 / depth_max) / (1 / depth_min - 1 / (depth_min + np.abs(depth_min) / fx))
+    else:
+        depth_num = np.full(model.num_images, float(max_d))
+    depth_interval = (depth_max - depth_min) / (depth_num - 1) / interval_scale
+    return np.stack([depth_min, depth_interval, depth_num, depth_max], axis=-1)
+
+
+def _mvsnet_cam_text(extrinsic, intrinsic, depth_range):
+    lines = ['extrinsic\n']
+    lines += [''.join([str(v) + ' ' for v in row]) + '\n' for row in extrinsic.tolist()]
+    lines.append('\nintrinsic\n')
+    lines += [''.join([str(v) + ' ' for v in row]) + '\n' for row in intrinsic.tolist()]
+    lines.append('\n' + ' '.join(['%f'] * len(depth_range)) % tuple(depth_range.tolist()) + '\n')
+    return ''.join(lines)
+
+
+def read_mvsnet_cam(path):
+    """(extrinsic (4, 4), intrinsic (3, 3), depth range values) of a cams/*_cam.txt file."""
+    with open(path, 'r') as f:
+        words = f.read().split()
+    extrinsic = np.array(words[1:17], dtype=np.float64).reshape(4, 4)
+    intrinsic = np.array(words[18:27], dtype=np.float64).reshape(3, 3)
+    return extrinsic, intrinsic, np.array(words[27:], dtype=np.float64)
+
+
+def write_scaled_mvsnet_cam(path, out_path, scale_x, scale_y, offset_x=0, offset_y=0):
+    """Copy of the cam file path for the image resized by (scale_x, scale_y),
+    then cropped at (offset_x, offset_y) of the resized image."""
+    extrinsic, intrinsic, depth_range = read_mvsnet_cam(path)
+    intrinsic[0] *= scale_x
+    intrinsic[1] *= scale_y
+    intrinsic[0, 2] -= offset_x
+    intrinsic[1, 2] -= offset_y
+    with open(out_path, 'w') as f:
+        f.write(_mvsnet_cam_text(extrinsic, intrinsic, depth_range))
+
+
+def _export_mvsnet_view(cam_path, cam_text, image_path, mvsnet_image_path):
+    with open(cam_path, 'w') as f:
+        f.write(cam_text)
+    if os.path.splitext(image_path)[1].lower() in JPEG_EXTENSIONS:
+        os.rename(image_path, mvsnet_image_path)
+    else:
+        image = cv2.imread(image_path)
+        if image is None or not cv2.imwrite(mvsnet_image_path, image):
+            logging.critical('can not convert %s', image_path)
+            exit(1)
+        os.remove(image_path)
+
+
+def export_colmap_to_mvsnet(output_dir, method='mvsnet', num_threads=None):
+    """Turn the undistorted COLMAP workspace output_dir (images/, sparse/) into
+    an MVSNet input: cams/%08d_cam.txt, images/%08d.jpg and pair.txt, images
+    indexed by image id order. The sparse model is read once from its binary
+    files, view selection uses pipeline.view_selection (method 'mvsnet' is
+    colmap2mvsnet.py's score), depth ranges mvsnet_depth_ranges; the per view
+    files are written by a thread pool."""
+    # pipeline.utils imports this module, so its dependents are imported here
+    from pipeline.view_selection import view_select, image_indices, write_pair_txt
+
+    images_dir = os.path.join(output_dir, 'images')
+    exlude_images = list(pathlib.Path(images_dir).iterdir())
     for image in exlude_images:
         assert len(image.stem) != 8
 
-    mvsnet_path = get_mvsnet_path()
-    colmap2mvsnet_path = os.path.join(mvsnet_path, 'mvsnet/colmap2mvsnet.py')
-    colmap2mvsnet_command_line = ['python', colmap2mvsnet_path,
-                                  '--dense_folder', output_dir]
-    if FLAGS.mvs_max_d is not None:
-        colmap2mvsnet_command_line.append('--max_d')
-        colmap2mvsnet_command_line.append(str(FLAGS.mvs_max_d))
-    logging.info('run colmap2mvsnet with command: %s', ' '.join(colmap2mvsnet_command_line))
-    subprocess.run(colmap2mvsnet_command_line, check=True)
+    model, views = view_select(os.path.join(output_dir, 'sparse'), method, FLAGS.mvs_view_num, FLAGS.num_cpu,
+                               model=ColmapModel.read(os.path.join(output_dir, 'sparse'), '.bin',
+                                                      cache=FLAGS.model_cache))
+    depth_ranges = mvsnet_depth_ranges(model, FLAGS.mvs_max_d)
+    poses = model.poses
+    extrinsics = np.zeros((model.num_images, 4, 4))
+    extrinsics[:, :3, :3] = poses.R
+    extrinsics[:, :3, 3] = poses.t
+    extrinsics[:, 3, 3] = 1
+    intrinsics = model.camera_matrices()[model.image_camera_rows()]
+    indices = image_indices(model)
+
+    cams_dir = os.path.join(output_dir, 'cams')
+    os.makedirs(cams_dir, exist_ok=True)
+    num_threads = num_threads or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(num_threads) as executor:
+        futures = [executor.submit(write_pair_txt, os.path.join(output_dir, 'pair.txt'), model, views)]
+        for image_row, index in enumerate(indices.tolist()):
+            futures.append(executor.submit(
+                _export_mvsnet_view, os.path.join(cams_dir, '%08d_cam.txt' % index),
+                _mvsnet_cam_text(extrinsics[image_row], intrinsics[image_row], depth_ranges[image_row]),
+                os.path.join(images_dir, model.images_arrays.names[image_row]),
+                os.path.join(images_dir, '%08d.jpg' % index)))
+        for future in futures:
+            future.result()
     for image in exlude_images:
-        image.unlink()
+        if image.exists():
+            image.unlink()
+    logging.info('exported %d views to mvsnet format in %s', model.num_images, output_dir)
 
 
 def run_mvsnet_predict(output_dir):
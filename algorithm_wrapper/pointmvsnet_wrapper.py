@@ -1,14 +1,16 @@
 # -*- coding: UTF-8 -*-
 
 import os
+import shutil
 import subprocess
+import multiprocessing as mp
 import pathlib
 import cv2
 import yaml
 import logging
 
 from pipeline.common_options import GLOBAL_OPTIONS as FLAGS
-from algorithm_wrapper.mvsnet_wrapper import get_fusibile_path
+from algorithm_wrapper.mvsnet_wrapper import get_fusibile_path, write_scaled_mvsnet_cam
 
 
 def get_pointmvsnet_path() -> str:
@@ -19,36 +21,140 @@ def get_pointmvsnet_path() -> str:
         return ''
 
 
-def fix_mvsnet_to_pointmvsnet(dataset_dir):
-    os.symlink(os.path.join(dataset_dir, 'cams'), os.path.join(dataset_dir, 'Cameras'))
-    images_dir = os.path.join(dataset_dir, 'Eval')
-    os.mkdir(images_dir)
-    images_dir = os.path.join(images_dir, 'Rectified')
-    os.mkdir(images_dir)
-    images_dir = os.path.join(images_dir, 'scan1')
-    os.mkdir(images_dir)
+# PointMVSNet downsamples its input 5 times, image sizes must be multiples of this
+POINTMVSNET_SIZE_MULTIPLE = 32
+
+
+def pointmvsnet_image_size(width, height, max_w=None, max_h=None):
+    """Size of an image scaled down (aspect kept) to fit in max_w x max_h, None for no limit."""
+    scale = min([1.] + [max_size / size for max_size, size in [(max_w, width), (max_h, height)]
+                        if max_size is not None])
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def _round_to_size_multiple(size):
+    return max(POINTMVSNET_SIZE_MULTIPLE, size // POINTMVSNET_SIZE_MULTIPLE * POINTMVSNET_SIZE_MULTIPLE)
+
+
+def pointmvsnet_image_geometry(width, height, max_w=None, max_h=None):
+    """(scaled size, output size, crop offset) of an image for PointMVSNet.
+
+    The image is scaled with pointmvsnet_image_size, then center cropped to
+    the largest multiple of POINTMVSNET_SIZE_MULTIPLE that fits (padded to it
+    if it is smaller); the crop offset is negative for padding.
+    """
+    scaled_size = pointmvsnet_image_size(width, height, max_w, max_h)
+    out_size = tuple(_round_to_size_multiple(size) for size in scaled_size)
+    offset = tuple((size - out) // 2 for size, out in zip(scaled_size, out_size))
+    return scaled_size, out_size, offset
+
+
+def _convert_pointmvsnet_image(task):
+    image_path, out_path, scaled_size, out_size, offset, png_compression = task
+    image_data = cv2.imread(image_path)
+    if image_data is None:
+        return image_path, False
+    if (image_data.shape[1], image_data.shape[0]) != scaled_size:
+        image_data = cv2.resize(image_data, scaled_size, interpolation=cv2.INTER_AREA)
+    if scaled_size != out_size:
+        pad = [max(0, -offset[1]), max(0, out_size[1] - scaled_size[1] + offset[1]),
+               max(0, -offset[0]), max(0, out_size[0] - scaled_size[0] + offset[0])]
+        if any(pad):
+            image_data = cv2.copyMakeBorder(image_data, *pad, cv2.BORDER_CONSTANT, value=0)
+        x, y = max(0, offset[0]), max(0, offset[1])
+        image_data = image_data[y:y + out_size[1], x:x + out_size[0]]
+    return image_path, cv2.imwrite(out_path, image_data, [cv2.IMWRITE_PNG_COMPRESSION, png_compression])
+
+
+def fix_mvsnet_to_pointmvsnet(dataset_dir, num_processes=None, png_compression=None):
+    """Lay the MVSNet scene in dataset_dir out as the PointMVSNet DTU test set:
+    Cameras/ and Eval/Rectified/scan1/rect_XXX_3_r5000.png.
+
+    Images are converted by num_processes worker processes (each decodes one
+    image at a time) with the PNG compression level png_compression, those
+    whose png is newer than the jpg and has the expected size are skipped.
+    With mvs_max_w / mvs_max_h the pngs are written at their final size (see
+    pointmvsnet_image_geometry) and Cameras/ holds cam files scaled and
+    shifted to match instead of linking cams/.
+    """
+    # pipeline.utils imports this module, so its dependents are imported here
+    from pipeline.utils import DetachFile
+    from pipeline.image_info import read_images_info
+
+    num_processes = num_processes or FLAGS.num_cpu
+    png_compression = FLAGS.png_compression if png_compression is None else png_compression
+    resize = FLAGS.mvs_max_w is not None or FLAGS.mvs_max_h is not None
+    cameras_dir = os.path.join(dataset_dir, 'Cameras')
+    # Cameras/ of a previous run with other mvs_max_w / mvs_max_h, never write through the cams/ link
+    if os.path.islink(cameras_dir) and resize:
+        os.unlink(cameras_dir)
+    elif os.path.isdir(cameras_dir) and not os.path.islink(cameras_dir) and not resize:
+        shutil.rmtree(cameras_dir)
+    if resize:
+        os.makedirs(cameras_dir, exist_ok=True)
+    elif not os.path.lexists(cameras_dir):
+        os.symlink(os.path.join(dataset_dir, 'cams'), cameras_dir)
+    images_dir = os.path.join(dataset_dir, 'Eval', 'Rectified', 'scan1')
+    os.makedirs(images_dir, exist_ok=True)
+
     original_image_dir = os.path.join(dataset_dir, 'images')
-    for image_path in pathlib.Path(original_image_dir).glob('*.jpg'):
-        basename = os.path.basename(image_path.stem)
-        if len(basename) != 8:
-            continue
-        idx = int(basename)
-        image_data = cv2.imread(image_path.absolute().as_posix())
-        cv2.imwrite(os.path.join(images_dir, 'rect_{:03d}_3_r5000.png'.format(idx + 1)), image_data)
-    os.symlink(os.path.join(dataset_dir, 'pair.txt'), os.path.join(dataset_dir, 'Cameras/pair.txt'))
+    image_paths = sorted([image_path for image_path in pathlib.Path(original_image_dir).glob('*.jpg')
+                          if len(image_path.stem) == 8])
+    tasks = []
+    for image_path, info in zip(image_paths, read_images_info(image_paths, with_exif=False)):
+        idx = int(image_path.stem)
+        if resize:
+            scaled_size, size, offset = pointmvsnet_image_geometry(info.width, info.height,
+                                                                   FLAGS.mvs_max_w, FLAGS.mvs_max_h)
+            DetachFile(os.path.join(cameras_dir, '%08d_cam.txt' % idx))
+            write_scaled_mvsnet_cam(os.path.join(dataset_dir, 'cams', '%08d_cam.txt' % idx),
+                                    os.path.join(cameras_dir, '%08d_cam.txt' % idx),
+                                    scaled_size[0] / info.width, scaled_size[1] / info.height, *offset)
+        else:
+            scaled_size, size, offset = (info.width, info.height), (info.width, info.height), (0, 0)
+        out_path = os.path.join(images_dir, 'rect_{:03d}_3_r5000.png'.format(idx + 1))
+        if os.path.isfile(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(image_path):
+            out_info = read_images_info([out_path], with_exif=False)[0]
+            if (out_info.width, out_info.height) == size:
+                continue
+        DetachFile(out_path)
+        tasks.append((image_path.absolute().as_posix(), out_path, scaled_size, size, offset, png_compression))
+    logging.info('convert %d images to png, %d up to date', len(tasks), len(image_paths) - len(tasks))
+
+    if num_processes > 1 and len(tasks) > 1:
+        with mp.Pool(min(num_processes, len(tasks))) as pool:
+            results = list(pool.imap_unordered(_convert_pointmvsnet_image, tasks))
+    else:
+        results = [_convert_pointmvsnet_image(task) for task in tasks]
+    failed = [image_path for image_path, ok in results if not ok]
+    if failed:
+        logging.critical('can not convert images %s', failed)
+        exit(1)
+    if not os.path.lexists(os.path.join(cameras_dir, 'pair.txt')):
+        os.symlink(os.path.join(dataset_dir, 'pair.txt'), os.path.join(cameras_dir, 'pair.txt'))
 
 
 def run_pointmvsnet_predict(mvs_work_dir):
+    from pipeline.image_info import read_image_info
+
     config_filepath = os.path.join(mvs_work_dir, 'pointmvsnet_cfg.yaml')
     with open(os.path.join(os.path.dirname(__file__), '../data/dtu_wde3.yaml'), 'r') as f_in:
         with open(config_filepath, 'w') as f_out:
             params = yaml.load(f_in)
             params['DATA']['TEST']['ROOT_DIR'] = mvs_work_dir
             params['OUTPUT_DIR'] = os.path.join(mvs_work_dir, 'depths')
-            if FLAGS.mvs_max_w is not None:
-                params['DATA']['TEST']['IMG_WIDTH'] = FLAGS.mvs_max_w
-            if FLAGS.mvs_max_h is not None:
-                params['DATA']['TEST']['IMG_HEIGHT'] = FLAGS.mvs_max_h
+            if FLAGS.mvs_max_w is not None or FLAGS.mvs_max_h is not None:
+                # fix_mvsnet_to_pointmvsnet already wrote the images at their final size
+                image_paths = sorted(pathlib.Path(mvs_work_dir, 'Eval', 'Rectified', 'scan1').glob('*.png'))
+                if image_paths:
+                    info = read_image_info(image_paths[0], with_exif=False)
+                    params['DATA']['TEST']['IMG_WIDTH'] = info.width
+                    params['DATA']['TEST']['IMG_HEIGHT'] = info.height
+                else:
+                    if FLAGS.mvs_max_w is not None:
+                        params['DATA']['TEST']['IMG_WIDTH'] = _round_to_size_multiple(FLAGS.mvs_max_w)
+                    if FLAGS.mvs_max_h is not None:
+                        params['DATA']['TEST']['IMG_HEIGHT'] = _round_to_size_multiple(FLAGS.mvs_max_h)
             if FLAGS.mvs_max_d is not None:
                 params['DATA']['TEST']['NUM_VIRTUAL_PLANE'] = FLAGS.mvs_max_d
             yaml.dump(params, f_out)
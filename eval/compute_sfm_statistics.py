@@ -6,10 +6,17 @@ import argparse
 import numpy as np
 import logging
 import math
+import json
+import collections
 from tqdm import tqdm
-from third_party.colmap.read_write_model import read_model
 from pipeline.utils import LogThanExitIfFailed, InitLogging
-import pickle
+from pipeline.colmap_model import ColmapModel, model_digest
+from pipeline.artifact_store import ArtifactStore
+from eval.quantile_sketch import KLLSketch
+from pipeline.camera_models import camera_from_colmap
+from pipeline.covisibility import CovisibilityIndex
+from pipeline.view_selection import colmap_scores, mvsnet_scores
+from third_party.colmap.read_write_model import qvecs2rotmats
 import multiprocessing as mp
 
 # This import registers the 3D projection, but is otherwise unused.
@@ -47,69 +54,6 @@ def show_3d_suface(depth, title=None, block=True):
     plt.show(block=block)
 
 
-class RadiaCamera:
-    def __init__(self, f, cx, cy, radia1, radia2):
-        self.radia2 = radia2
-        self.radia1 = radia1
-        self.cy = cy
-        self.cx = cx
-        self.f = f
-        self.fx = f
-        self.fy = f
-        self.K = np.array([[f, 0, cx], [0, f, cy], [0, 0, 1]])
-        self.K_inv = np.linalg.inv(self.K)
-
-    def __call__(self, p):
-        r2 = p[0] * p[0] + p[1] * p[1]
-        coef = 1.0 + r2 * self.radia1 + r2 * r2 * self.radia2
-        ret = p * coef
-        return np.array((ret[0] * self.f + self.cx, ret[1] * self.f + self.cy))
-
-
-class PinholeCamera:
-    def __init__(self, fx, fy, cx, cy):
-        self.cy = cy
-        self.cx = cx
-        self.fx = fx
-        self.fy = fy
-        self.K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
-        self.K_inv = np.linalg.inv(self.K)
-
-    def __call__(self, p):
-        return np.array((p[0] * self.fx + self.cx, p[1] * self.fy + self.cy))
-
-
-class OpencvCamera:
-    def __init__(self, fx, fy, cx, cy, k1, k2, p1, p2, k3, k4, k5, k6):
-        self.fx = fx
-        self.fy = fy
-        self.cx = cx
-        self.cy = cy
-        self.k1 = k1
-        self.k2 = k2
-        self.p1 = p1
-        self.p2 = p2
-        self.k3 = k3
-        self.k4 = k4
-        self.k5 = k5
-        self.k6 = k6
-
-    def __call__(self, p):
-        u2 = p[0] * p[0]
-        v2 = p[1] * p[1]
-        r2 = u2 + v2
-        r4 = r2 * r2
-        r6 = r4 * r4
-        uv = p[0] * p[1]
-        coef = (1.0 + r2 * self.k1 + r4 * self.k2 + r6 * self.k3) / (1.0 + r2 * self.k4 + r4 * self.k5 + r6 * self.k6)
-        delta1 = 2 * self.p1 * uv + (r2 + 2. * u2) * self.p2
-        delta2 = 2 * self.p2 * uv + (r2 + 2. * v2) * self.p1
-        ret = p * coef
-        p[0] = p[0] + delta1
-        p[1] = p[1] + delta2
-        return np.array((ret[0] * self.fx + self.cx, ret[1] * self.fy + self.cy))
-
-
 def FindOrConvertSfmResultToColmap(options):
     sfm_model_path = os.path.join(options.sfm_path, 'sfm_colmap')
     if options.alg_type == 'colmap':
@@ -137,77 +81,162 @@ def FindOrConvertSfmResultToColmap(options):
 def format_camera(cameras):
     new_camers = {}
     for camera_id, camera in cameras.items():
-        if camera.model in ['RADIAL', 'SIMPLE_RADIAL']:
-            if len(camera.params) == 4:
-                radia2 = 0
-            else:
-                radia2 = camera.params[4]
-            new_camers[camera_id] = RadiaCamera(camera.params[0], camera.params[1], camera.params[2], camera.params[3],
-                                                radia2)
-        elif camera.model in ['PINHOLE', 'SIMPLE_PINHOLE']:
-            if len(camera.params) == 4:
-                new_camers[camera_id] = PinholeCamera(camera.params[0], camera.params[1], camera.params[2],
-                                                      camera.params[3])
-            else:
-                assert len(camera.params) == 3
-                new_camers[camera_id] = PinholeCamera(camera.params[0], camera.params[0], camera.params[1],
-                                                      camera.params[2])
-        elif camera.model in ['FULL_OPENCV']:
-            new_camers[camera_id] = OpencvCamera(*camera.params)
-        else:
-            LogThanExitIfFailed(False, 'unsupport camera type: %s', camera.model)
-        new_camers[camera_id].height = camera.height
-        new_camers[camera_id].width = camera.width
-        new_camers[camera_id].min_w, new_camers[camera_id].min_h, _ = new_camers[camera_id].K_inv.dot([0, 0, 1])
+        new_camers[camera_id] = camera_from_colmap(camera)
+        new_camers[camera_id].min_w, new_camers[camera_id].min_h, _ = new_camers[camera_id].K_inv.dot(
+            [0, 0, 1]).tolist()
         new_camers[camera_id].max_w, new_camers[camera_id].max_h, _ = new_camers[camera_id].K_inv.dot(
-            [camera.width, camera.height, 1])
+            [camera.width, camera.height, 1]).tolist()
 
     return new_camers
 
 
 def format_images(images):
-    for image_id, image in images.items():
-        image.mat = image.qvec2rotmat()
-        image.centor = -image.mat.dot(image.tvec)
+    image_list = list(images.values())
+    if len(image_list) == 0:
+        return
+    mats = qvecs2rotmats([image.qvec for image in image_list])
+    centors = -np.einsum('nij,nj->ni', mats, np.array([image.tvec for image in image_list]))
+    for image, mat, centor in zip(image_list, mats, centors):
+        image.mat = mat
+        image.centor = centor
 
 
 def ProjectPoint(camera, image, p_in):
-    p = image.qvec2rotmat().dot(p_in) + image.tvec
+    mat = image.mat if hasattr(image, 'mat') else image.qvec2rotmat()
+    p = mat.dot(p_in) + image.tvec
     return camera(p[:2] / p[2]), p[2]
 
 
-def PrintReprojectionErrors(cameras, images, points3D):
-    reprojection_errors = []
-    num_projections_behind_camera = 0
+ReprojectionErrors = collections.namedtuple(
+    "ReprojectionErrors",
+    ["errors", "depths", "behind_camera", "mean", "median", "image_mean_errors", "point_mean_errors"])
+
+# (cameras, model) of the running compute_reprojection_errors / compute_statistics, set in every pool worker
+# by its initializer so the workers get the model arrays once instead of a pickled copy per chunk
+_reprojection_state = None
+
+
+def _init_reprojection_state(cameras, model):
+    global _reprojection_state
+    _reprojection_state = (cameras, model)
+
+
+def _project_chunk(begin, end):
+    """(image rows, point rows, reprojection errors, depths) of the flat track elements [begin, end)."""
+    cameras, model = _reprojection_state
+    image_rows = model.image_rows_of(model.points3D_arrays.track_image_ids[begin:end])
+    point_rows = np.searchsorted(model.points3D_arrays.track_offsets, np.arange(begin, end), side='right') - 1
+    keypoint_rows = model.images_arrays.point2D_offsets[image_rows] + model.points3D_arrays.track_point2D_idxs[begin:end]
+    mismatch = np.flatnonzero(
+        model.images_arrays.point3D_ids[keypoint_rows] != model.points3D_arrays.ids[point_rows])
+    if len(mismatch) > 0:
+        image_row = image_rows[mismatch[0]]
+        camera = model.cameras[int(model.camera_ids[model.image_camera_rows()[image_row]])]
+        raise ValueError('track of point %d refers to keypoint %d of image %s (%s camera), which is not that point'
+                         % (model.points3D_arrays.ids[point_rows[mismatch[0]]],
+                            model.points3D_arrays.track_point2D_idxs[begin + mismatch[0]],
+                            model.images_arrays.names[image_row], camera.model))
+
+    poses = model.poses
+    p = np.einsum('nij,nj->ni', poses.R[image_rows], model.points3D_arrays.xyzs[point_rows]) + poses.t[image_rows]
+    uv = p[:, :2] / p[:, 2:3]
+
+    # project every camera's observations in one call
+    camera_rows = model.image_camera_rows()[image_rows]
+    order = np.argsort(camera_rows, kind='stable')
+    projections = np.empty_like(uv)
+    for group in np.split(order, np.flatnonzero(np.diff(camera_rows[order])) + 1):
+        if len(group) > 0:
+            projections[group] = cameras[int(model.camera_ids[camera_rows[group[0]]])](uv[group])
+
+    features = model.images_arrays.xys[keypoint_rows]
+    return image_rows, point_rows, np.linalg.norm(features - projections, axis=-1), p[:, 2]
+
+
+def _reprojection_chunk(bounds):
+    _, _, errors, depths = _project_chunk(*bounds)
+    return errors, depths
+
+
+def _map_chunks(chunk_fun, cameras, model, chunk_size, num_processes):
+    """chunk_fun over [begin, end) chunks of the flat track elements, in a process pool if num_processes > 1."""
+    global _reprojection_state
+    num_observations = len(model.points3D_arrays.track_image_ids)
+    chunks = [(begin, min(begin + chunk_size, num_observations)) for begin in range(0, num_observations, chunk_size)]
+    # build the lazily computed lookups before they are sent to the workers
+    model.poses
+    model.image_rows_of(np.empty(0, dtype=np.int64))
+    _reprojection_state = (cameras, model)
+    try:
+        if num_processes > 1 and len(chunks) > 1:
+            with mp.Pool(min(num_processes, len(chunks)), initializer=_init_reprojection_state,
+                         initargs=(cameras, model)) as pool:
+                yield from pool.imap(chunk_fun, chunks)
+        else:
+            yield from map(chunk_fun, chunks)
+    finally:
+        _reprojection_state = None
+
+
+def _sketch_chunk(bounds):
+    """Mergeable summary of the flat track elements [begin, end) for compute_statistics(streaming=True)."""
+    image_rows, _, errors, depths = _project_chunk(*bounds)
+    num_images = _reprojection_state[1].num_images
+    error_sketch = KLLSketch()
+    error_sketch.update(errors)
+    depth_sketches = {}
+    order = np.argsort(image_rows, kind='stable')
+    for group in np.split(order, np.flatnonzero(np.diff(image_rows[order])) + 1):
+        if len(group) > 0:
+            depth_sketches[int(image_rows[group[0]])] = KLLSketch()
+            depth_sketches[int(image_rows[group[0]])].update(depths[group])
+    return (error_sketch, depth_sketches, np.bincount(image_rows, minlength=num_images),
+            np.bincount(image_rows, weights=errors, minlength=num_images), np.count_nonzero(depths < 0))
+
+
+def _mean_by_row(values, rows, num_rows):
+    counts = np.bincount(rows, minlength=num_rows)
+    sums = np.bincount(rows, weights=values, minlength=num_rows)
+    return np.divide(sums, counts, out=np.full(num_rows, np.nan), where=counts > 0)
+
+
+def compute_reprojection_errors(cameras, model, chunk_size=1 << 20, num_processes=1):
+    """Reprojection error of every track observation of model (a ColmapModel), in flat track order.
+
+    cameras are the format_camera objects. Observations are projected chunk_size at a time, per camera group, in
+    num_processes worker processes. Also returns the depth of every observation, the behind camera mask, mean,
+    median (the upper one, as PrintReprojectionErrors always reported) and the mean error of every image row and point
+    row (nan if unobserved).
+    """
+    results = list(_map_chunks(_reprojection_chunk, cameras, model, chunk_size, num_processes))
+    image_rows = model.track_image_rows()
+    point_rows = model.track_point3D_rows()
+    num_observations = len(image_rows)
+
+    errors = np.concatenate([result[0] for result in results]) if results else np.empty(0)
+    depths = np.concatenate([result[1] for result in results]) if results else np.empty(0)
+    if num_observations > 0:
+        mean = float(errors.mean())
+        median = float(np.partition(errors, num_observations // 2)[num_observations // 2])
+    else:
+        mean = median = float('nan')
+    return ReprojectionErrors(errors, depths, depths < 0, mean, median,
+                              _mean_by_row(errors, image_rows, model.num_images),
+                              _mean_by_row(errors, point_rows, model.num_points3D))
+
+
+def PrintReprojectionErrors(cameras, model, num_processes=1):
+    reprojection_errors = compute_reprojection_errors(cameras, model, num_processes=num_processes)
 
-    for track_id, track in points3D.items():
-        for view_id, feature_id in zip(track.image_ids, track.point2D_idxs):
-            image = images[view_id]
-            camera = cameras[image.camera_id]
-            assert track_id == image.point3D_ids[feature_id]
-            # feature_id = np.where(image.point3D_ids == track_id)
-            feature = image.xys[feature_id]
-
-            projection, z = ProjectPoint(camera, image, track.xyz)
-            if z < 0:
-                num_projections_behind_camera = num_projections_behind_camera + 1;
-
-            # Compute reprojection error.
-            reprojection_error = np.linalg.norm(feature - projection)
-            reprojection_errors.append(reprojection_error)
-
-    if len(reprojection_errors) == 0:
+    if len(reprojection_errors.errors) == 0:
         logging.info("No estimated 3d points were found. Cannot compute "
                      "reprojection error statistics.")
         return
 
-    reprojection_errors.sort()
-    mean_reprojection_error = sum(reprojection_errors) / len(reprojection_errors)
-    median_reprojection_error = reprojection_errors[len(reprojection_errors) // 2]
-
     logging.info(
         "\nNum observations: %d\nNum reprojections behind camera: %d\nMean reprojection error = %f\nMedian reprojection_error = %f",
-        len(reprojection_errors), num_projections_behind_camera, mean_reprojection_error, median_reprojection_error)
+        len(reprojection_errors.errors), np.count_nonzero(reprojection_errors.behind_camera),
+        reprojection_errors.mean, reprojection_errors.median)
 
 
 def PrintTrackLengthHistogram(cameras, images, points3D):
@@ -234,183 +263,199 @@ def PrintTrackLengthHistogram(cameras, images, points3D):
     logging.info("Track length histogram = \n%s", histogram)
 
 
-def colmap_view_select(cameras, images, points3D):
-    point_shared = {}
-    angles = {}
-    scores = {}
-    image_depth_range = {}
-    for image_id, image in images.items():
-        point_shared[image_id] = {}
-        angles[image_id] = {}
-        scores[image_id] = {}
-        image_depth_range[image_id] = []
-        for image_id_y, image in images.items():
-            point_shared[image_id][image_id_y] = []
-            angles[image_id][image_id_y] = []
-            scores[image_id][image_id_y] = 0
-
-    for track_id, track in tqdm(points3D.items()):
-        for i in range(len(track.image_ids)):
-            image_depth_range[track.image_ids[i]].append(track.xyz)
-            for j in range(i + 1, len(track.image_ids)):
-                if track.image_ids[i] < track.image_ids[j]:
-                    point_shared[track.image_ids[i]][track.image_ids[j]].append(track.xyz)
-                elif track.image_ids[j] < track.image_ids[i]:
-                    point_shared[track.image_ids[j]][track.image_ids[i]].append(track.xyz)
-
-    for k, v in image_depth_range.items():
-        proj = images[k].mat.dot(np.array(v).T) + images[k].tvec[:, None]
-        image_depth_range[k] = np.sort(proj[2])
-
-    for k1, v1 in point_shared.items():
-        for k2, v2 in v1.items():
-            if k1 >= k2:
-                continue
-            if len(point_shared[k1][k2]) == 0:
-                continue
-            share_vec = np.array(point_shared[k1][k2])
-            d1 = np.sum(np.square(share_vec - images[k1].centor[None, :]), axis=-1)
-            d2 = np.sum(np.square(share_vec - images[k2].centor[None, :]), axis=-1)
-            d3 = np.square(images[k1].centor - images[k2].centor).sum()
-            tmp = 2. * np.sqrt(d1 * d2)
-            angle = np.abs(np.arccos((d1 + d2 - d3) / tmp))
-            angle = np.minimum(angle, math.pi - angle)
-            angles[k1][k2] = angle
-            angles[k2][k1] = angle
-
-
-    # for track_id, track in tqdm(points3D.items()):
-    #     for id_x in track.image_ids:
-    #         for id_y in track.image_ids:
-    #             if id_x == id_y:
-    #                 continue
-    #             d1 = np.square(track.xyz - images[id_x].centor).sum()
-    #             d2 = np.square(track.xyz - images[id_y].centor).sum()
-    #             d3 = np.square(images[id_x].centor - images[id_y].centor).sum()
-    #             tmp = 2. * np.sqrt(d1 * d2)
-    #             if tmp == 0.:
-    #                 continue
-    #             angle = np.abs(np.arccos((d1 + d2 - d3) / tmp))
-    #             angle = np.min([angle, math.pi - angle])
-    #             point_shared[id_x][id_y] += 1
-    #             angles[id_x][id_y].append(angle)
-    #             point_shared[id_y][id_x] += 1
-    #             angles[id_y][id_x].append(angle)
-
-    for image_id, image in images.items():
-        for image_id_y, image in images.items():
-            if image_id == image_id_y:
-                continue
-            if len(angles[image_id][image_id_y]) < 100:
-                continue
-            percentile = int(np.round(75 * len(angles[image_id][image_id_y]) / 100))
-            angle = np.partition(angles[image_id][image_id_y], percentile)[percentile]
-            if angle >= (1. * math.pi / 180.):
-                scores[image_id][image_id_y] = len(angles[image_id][image_id_y])
-
-    with open('/tmp/colmap_dump.pikle', 'wb') as f:
-        pickle.dump(scores, f)
-    with open('/tmp/colmap_depth.pikle', 'wb') as f:
-        pickle.dump(image_depth_range, f)
-
-def mvsnet_view_select(cameras, images, points3D):
-    point_shared = {}
-    scores = {}
-    image_depth_range = {}
-    for image_id, image in images.items():
-        point_shared[image_id] = {}
-        scores[image_id] = {}
-        image_depth_range[image_id] = []
-        for image_id_y, image in images.items():
-            point_shared[image_id][image_id_y] = []
-            scores[image_id][image_id_y] = 0
-
-    for track_id, track in tqdm(points3D.items()):
-        for i in range(len(track.image_ids)):
-            image_depth_range[track.image_ids[i]].append(track.xyz)
-            for j in range(i + 1, len(track.image_ids)):
-                if track.image_ids[i] < track.image_ids[j]:
-                    point_shared[track.image_ids[i]][track.image_ids[j]].append(track.xyz)
-                elif track.image_ids[j] < track.image_ids[i]:
-                    point_shared[track.image_ids[j]][track.image_ids[i]].append(track.xyz)
-
-    for k, v in image_depth_range.items():
-        proj = images[k].mat.dot(np.array(v).T) + images[k].tvec[:, None]
-        image_depth_range[k] = np.sort(proj[2])
-
-    for k1, v1 in point_shared.items():
-        for k2, v2 in v1.items():
-            if k1 >= k2:
-                continue
-            if len(point_shared[k1][k2]) == 0:
-                continue
-            share_vec = np.array(point_shared[k1][k2])
-            d1 = np.sum(np.square(share_vec - images[k1].centor[None, :]), axis=-1)
-            d2 = np.sum(np.square(share_vec - images[k2].centor[None, :]), axis=-1)
-            d3 = np.square(images[k1].centor - images[k2].centor).sum()
-            tmp = 2. * np.sqrt(d1 * d2)
-            angle = np.abs(np.arccos((d1 + d2 - d3) / tmp))
-            angle = 180*np.minimum(angle, math.pi - angle)/math.pi
-            kernel = np.where(angle < 5, (angle - 5.) / 1., (angle - 5.) / 10.)
-            score = np.exp(-kernel * kernel / 2)
-            scores[k1][k2] = np.sum(score)
-            scores[k2][k1] = np.sum(score)
-
-    # for track_id, track in tqdm(points3D.items()):
-    #     for id_x in track.image_ids:
-    #         for id_y in track.image_ids:
-    #             if id_x == id_y:
-    #                 continue
-    #             d1 = np.square(track.xyz - images[id_x].centor).sum()
-    #             d2 = np.square(track.xyz - images[id_y].centor).sum()
-    #             d3 = np.square(images[id_x].centor - images[id_y].centor).sum()
-    #             tmp = 2. * np.sqrt(d1 * d2)
-    #             if tmp == 0.:
-    #                 continue
-    #             angle = np.abs(np.arccos((d1 + d2 - d3) / tmp))
-    #             angle = 180. * np.min([angle, math.pi - angle]) / math.pi
-    #             if angle < 5:
-    #                 kernel = (angle - 5.) / 1.
-    #             else:
-    #                 kernel = (angle - 5.) / 10.
-    #             score = math.exp(-kernel * kernel / 2)
-    #             point_shared[id_x][id_y] += score
-    #             point_shared[id_y][id_x] += score
-
-    with open('/tmp/mvsnet_dump.pikle', 'wb') as f:
-        pickle.dump(scores, f)
-    with open('/tmp/mvsnet_depth.pikle', 'wb') as f:
-        pickle.dump(image_depth_range, f)
+TRACK_LENGTH_BINS = [2, 3, 4, 5, 6, 7, 8, 9, 10, 15, 20, 25, 50]
+REPROJECTION_ERROR_QUANTILES = [0.5, 0.9, 0.95, 0.99]
+DEPTH_PERCENTILES = [1, 5, 50, 95, 99]
+
+
+def _json_float(value):
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def _grouped_nearest_rank(values, rows, num_rows, fractions):
+    """values[int(n * fraction)] of the sorted values of every row (n values), nan for empty rows, (rows, fractions)."""
+    sorted_values = values[np.lexsort((values, rows))]
+    counts = np.bincount(rows, minlength=num_rows)
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    ranks = np.minimum((counts[:, None] * np.asarray(fractions)[None, :]).astype(np.int64),
+                       np.maximum(counts[:, None] - 1, 0))
+    if len(sorted_values) == 0:
+        return np.full((num_rows, len(fractions)), np.nan)
+    positions = np.minimum(offsets[:-1, None] + ranks, len(sorted_values) - 1)
+    return np.where(counts[:, None] > 0, sorted_values[positions], np.nan)
+
+
+def _streaming_reprojection_summary(cameras, model, chunk_size, num_processes):
+    """(error sketch, per image row depth sketches, observation counts and error sums, behind camera count).
+
+    Everything is accumulated chunk by chunk, no per observation array of the whole model is built."""
+    error_sketch = KLLSketch()
+    depth_sketches = [KLLSketch() for _ in range(model.num_images)]
+    counts = np.zeros(model.num_images, dtype=np.int64)
+    error_sums = np.zeros(model.num_images)
+    num_behind_camera = 0
+    for chunk_error_sketch, chunk_depth_sketches, chunk_counts, chunk_error_sums, chunk_num_behind_camera in \
+            _map_chunks(_sketch_chunk, cameras, model, chunk_size, num_processes):
+        error_sketch.merge(chunk_error_sketch)
+        for row, sketch in chunk_depth_sketches.items():
+            depth_sketches[row].merge(sketch)
+        counts += chunk_counts
+        error_sums += chunk_error_sums
+        num_behind_camera += chunk_num_behind_camera
+    return error_sketch, depth_sketches, counts, error_sums, num_behind_camera
+
+
+def compute_statistics(cameras, model, num_processes=1, streaming=False, chunk_size=1 << 20):
+    """All SfM statistics of model from one projection pass over its observations, as a json-able dict.
+
+    Track length histogram (TRACK_LENGTH_BINS, last bin up to the longest
+    track), observation counts, reprojection error mean and quantiles, behind
+    camera count, and per image observation count, mean reprojection error and
+    depth percentiles (nearest rank, like the sorted depth lists of the view
+    selection). Missing values are None.
+
+    With streaming=True no per observation array of the whole model is built:
+    every chunk of chunk_size observations is summarized into per image counts
+    and error sums and KLLSketch quantile sketches that are merged, so
+    quantiles and percentiles are approximate (see KLLSketch for the error
+    bound), counts and means stay exact.
+    """
+    track_lengths = model.track_lengths
+    num_observations = len(model.points3D_arrays.track_image_ids)
+    depth_fractions = [p / 100. for p in DEPTH_PERCENTILES]
+
+    if streaming:
+        error_sketch, depth_sketches, num_image_observations, error_sums, num_behind_camera = \
+            _streaming_reprojection_summary(cameras, model, chunk_size, num_processes)
+        error_mean = error_sums.sum() / num_observations if num_observations > 0 else float('nan')
+        error_median = error_sketch.quantile(0.5)
+        error_quantiles = error_sketch.quantile(REPROJECTION_ERROR_QUANTILES)
+        image_mean_errors = np.divide(error_sums, num_image_observations, out=np.full(model.num_images, np.nan),
+                                      where=num_image_observations > 0)
+        depth_percentiles = np.stack([sketch.quantile(depth_fractions) for sketch in depth_sketches]) \
+            if model.num_images > 0 else np.empty((0, len(DEPTH_PERCENTILES)))
+    else:
+        image_rows = model.track_image_rows()
+        num_image_observations = np.bincount(image_rows, minlength=model.num_images)
+        reprojection = compute_reprojection_errors(cameras, model, chunk_size, num_processes)
+        error_mean, error_median = reprojection.mean, reprojection.median
+        error_quantiles = np.quantile(reprojection.errors, REPROJECTION_ERROR_QUANTILES) if num_observations > 0 \
+            else np.full(len(REPROJECTION_ERROR_QUANTILES), np.nan)
+        num_behind_camera = np.count_nonzero(reprojection.behind_camera)
+        image_mean_errors = reprojection.image_mean_errors
+        depth_percentiles = _grouped_nearest_rank(reprojection.depths, image_rows, model.num_images,
+                                                  depth_fractions)
+
+    statistics = {'num_cameras': len(model.cameras), 'num_images': model.num_images,
+                  'num_points3D': model.num_points3D, 'num_observations': num_observations, 'streaming': streaming}
+
+    bins = TRACK_LENGTH_BINS + [max(TRACK_LENGTH_BINS[-1] + 1, int(track_lengths.max(initial=0)))]
+    histogram, _ = np.histogram(track_lengths, bins=bins)
+    statistics['track_length'] = {
+        'mean': _json_float(track_lengths.mean()) if model.num_points3D > 0 else None,
+        'median': _json_float(np.median(track_lengths)) if model.num_points3D > 0 else None,
+        'max': int(track_lengths.max(initial=0)),
+        'histogram': {'bins': bins, 'counts': histogram.tolist()}}
+
+    statistics['reprojection_error'] = {
+        'mean': _json_float(error_mean), 'median': _json_float(error_median),
+        'quantiles': {str(q): _json_float(v) for q, v in zip(REPROJECTION_ERROR_QUANTILES, error_quantiles)},
+        'num_behind_camera': int(num_behind_camera)}
+
+    images = {}
+    for row, image_id in enumerate(model.images_arrays.ids.tolist()):
+        images[str(image_id)] = {
+            'name': model.images_arrays.names[row],
+            'num_observations': int(num_image_observations[row]),
+            'mean_reprojection_error': _json_float(image_mean_errors[row]),
+            'depth_percentiles': {str(p): _json_float(v) for p, v in zip(DEPTH_PERCENTILES, depth_percentiles[row])}}
+    statistics['images'] = images
+    return statistics
+
+
+def write_statistics(statistics, path):
+    with open(path, 'w') as f:
+        json.dump(statistics, f, indent=2)
+
+
+def image_depth_ranges(model):
+    """Sorted depths of the track observations of every image row, CSR: (offsets, depths)."""
+    poses = model.poses
+    image_rows = model.track_image_rows()
+    xyzs = model.points3D_arrays.xyzs[model.track_point3D_rows()]
+    depths = np.einsum('nj,nj->n', poses.R[image_rows, 2], xyzs) + poses.t[image_rows, 2]
+    depths = depths[np.lexsort((depths, image_rows))]
+    offsets = np.zeros(model.num_images + 1, dtype=np.int64)
+    np.cumsum(np.bincount(image_rows, minlength=model.num_images), out=offsets[1:])
+    return offsets, depths
+
+
+def view_select_arrays(model, covisibility, pair_scores):
+    """View selection artifact: sparse pair scores (pair_image_ids, pair_scores) and the depth samples of every
+    image (depth_offsets, depths, by image_ids order)."""
+    image_ids = model.images_arrays.ids
+    depth_offsets, depths = image_depth_ranges(model)
+    return {'image_ids': image_ids, 'pair_image_ids': image_ids[covisibility.pair_image_rows],
+            'pair_scores': pair_scores, 'depth_offsets': depth_offsets, 'depths': depths}
+
+
+def pair_scores_to_dict(view_selection):
+    """{image_id: {image_id_y: score}} of the covisible pairs of a view selection artifact, symmetric."""
+    scores = {image_id: {} for image_id in view_selection['image_ids'].tolist()}
+    for (a, b), score in zip(view_selection['pair_image_ids'].tolist(), view_selection['pair_scores'].tolist()):
+        scores[a][b] = score
+        scores[b][a] = score
+    return scores
+
+
+def depth_samples_to_dict(view_selection):
+    """{image_id: sorted depths} of a view selection artifact, views into its (mmapped) depths."""
+    offsets = view_selection['depth_offsets']
+    depths = view_selection['depths']
+    return {image_id: depths[offsets[row]:offsets[row + 1]]
+            for row, image_id in enumerate(view_selection['image_ids'].tolist())}
+
+
+def colmap_view_select(model, covisibility=None):
+    if covisibility is None:
+        covisibility = CovisibilityIndex.from_model(model)
+    pair_scores = colmap_scores(covisibility.triangulation_angles(), covisibility.pair_entry_pairs(),
+                                covisibility.num_pairs)
+    return view_select_arrays(model, covisibility, pair_scores)
+
+
+def mvsnet_view_select(model, covisibility=None):
+    if covisibility is None:
+        covisibility = CovisibilityIndex.from_model(model)
+    pair_scores = mvsnet_scores(covisibility.triangulation_angles(), covisibility.pair_entry_pairs(),
+                                covisibility.num_pairs)
+    return view_select_arrays(model, covisibility, pair_scores)
+
+
+def _axis_depth_range(T, src_pos, axis, range_axis):
+    """Depth interval along the reference rays that projects inside [range_axis[0], range_axis[1]] on one image axis."""
+    denominator = src_pos[..., axis:axis + 1] - src_pos[..., 2:3] * range_axis[None, None, :]
+    numerator = T[2] * range_axis - T[axis]
+
+    assert np.all(denominator != 0.)
+
+    depth_range = numerator[None, None, :] / denominator
+    mask = (denominator[..., 0] < 0) ^ (denominator[..., 1] < 0.)
+    depth_min = np.minimum(depth_range[..., 0], depth_range[..., 1])
+    depth_max = np.maximum(depth_range[..., 0], depth_range[..., 1])
+    return np.where(mask, depth_max, depth_min), np.where(mask, np.inf, depth_max)
+
 
 def get_depth_range(T, src_pos, camera):
-    range_w = np.array([camera.min_w, camera.max_w])
-    denominator_w = src_pos[..., 0:1] - src_pos[..., 2:3] * range_w[None, None, :]
-    numerator_w = T[2] * range_w - T[0]
-
-    assert np.all(denominator_w != 0.)
-
-    depth_range_w = numerator_w[None, None, :] / denominator_w
-    mask_w = (denominator_w[..., 0:1] < 0) ^ (denominator_w[..., 1:2] < 0.)
-    depth_max_w = np.max(depth_range_w, axis=-1)
-    depth_range_w = np.sort(depth_range_w, axis=-1)
-    depth_range_w = np.where(mask_w, np.stack([depth_max_w, np.full_like(depth_max_w, fill_value=np.PINF)], axis=-1),
-                             depth_range_w)
-
-    range_h = np.array([camera.min_h, camera.max_h])
-    denominator_h = src_pos[..., 1:2] - src_pos[..., 2:3] * range_h[None, None, :]
-    numerator_h = T[2] * range_h - T[1]
-
-    assert np.all(denominator_h != 0.)
-
-    depth_range_h = numerator_h[None, None, :] / denominator_h
-    mask_h = (denominator_h[..., 0:1] < 0) ^ (denominator_h[..., 1:2] < 0.)
-    depth_max_h = np.max(depth_range_h, axis=-1)
-    depth_range_h = np.sort(depth_range_h, axis=-1)
-    depth_range_h = np.where(mask_h, np.stack([depth_max_h, np.full_like(depth_max_h, fill_value=np.PINF)], axis=-1),
-                             depth_range_h)
-
-    range_min = np.maximum(depth_range_w[..., 0], depth_range_h[..., 0])
-    range_max = np.minimum(depth_range_w[..., 1], depth_range_h[..., 1])
+    range_min_w, range_max_w = _axis_depth_range(
+        T, src_pos, 0, np.array([camera.min_w, camera.max_w], dtype=src_pos.dtype))
+    range_min_h, range_max_h = _axis_depth_range(
+        T, src_pos, 1, np.array([camera.min_h, camera.max_h], dtype=src_pos.dtype))
+
+    range_min = np.maximum(range_min_w, range_min_h)
+    range_max = np.minimum(range_max_w, range_max_h)
     range_min = np.where(range_min < 0., 0, range_min)
 
     valid_3d = -T[2] / src_pos[:, :, 2]
@@ -440,34 +485,43 @@ def get_disparity_range(projection, direction, camera):
     return solution
 
 
-def disparity_compute(cameras, images, points3D):
-    with open('/tmp/mvsnet_dump.pikle', 'rb') as f:
-        scores = pickle.load(f)
-    with open('/tmp/mvsnet_depth.pikle', 'rb') as f:
-        image_depth_range = pickle.load(f)
+# (cameras, images, scores, num_neighbors, tile_rows) of the running disparity_compute, set in every pool worker
+# by its initializer
+_disparity_state = None
 
-    for camera_id, camera in cameras.items():
-        pass
-    grid = np.empty([camera.height, camera.width, 3], dtype=np.float64)
-    for h in range(camera.height):
-        for w in range(camera.width):
-            grid[h, w] = np.array([w + 0.5, h + 0.5, 1.])
-
-    for image_id, image in images.items():
-        camera = cameras[image.camera_id]
-        order_map = sorted(scores[image_id].items(), key=lambda x: x[1], reverse=True)
-        ref_pos = np.squeeze(np.matmul(camera.K_inv[None, None, :, :], grid[:, :, :, None]), axis=-1)
-        ref_pos = ref_pos / np.linalg.norm(ref_pos, axis=-1, keepdims=True)
-
-        for i in range(10):
-            image_id_y = order_map[i][0]
-            image_y = images[image_id_y]
-            R = image_y.mat.dot(image.mat.T)
-            T = image_y.tvec - R.dot(image.tvec)
-            centor = T[:2] / T[2]
-
-            src_pos = np.squeeze(np.matmul(R[None, None, :, :], ref_pos[:, :, :, None]), axis=-1)
 
+def _init_disparity_state(*state):
+    global _disparity_state
+    _disparity_state = state
+
+
+def pixel_rays(camera, row_begin, row_end, dtype=np.float32):
+    """Unit viewing rays through the pixel centers of rows [row_begin, row_end), (rows, width, 3)."""
+    xs = np.arange(camera.width, dtype=dtype) + dtype(0.5)
+    ys = np.arange(row_begin, row_end, dtype=dtype) + dtype(0.5)
+    pixels = np.stack(np.broadcast_arrays(xs[None, :], ys[:, None], dtype(1.)), axis=-1)
+    rays = np.matmul(pixels, camera.K_inv.T.astype(dtype))
+    return rays / np.linalg.norm(rays, axis=-1, keepdims=True)
+
+
+def _disparity_image(image_id):
+    cameras, images, scores, num_neighbors, tile_rows = _disparity_state
+    image = images[image_id]
+    camera = cameras[image.camera_id]
+    order_map = sorted(scores[image_id].items(), key=lambda x: x[1], reverse=True)[:num_neighbors]
+
+    results = []
+    for image_id_y, _ in order_map:
+        image_y = images[image_id_y]
+        R = image_y.mat.dot(image.mat.T)
+        T = image_y.tvec - R.dot(image.tvec)
+        centor = T[:2] / T[2]
+
+        min_depth, max_depth, max_disparity = np.inf, -np.inf, 0.
+        for row_begin in range(0, camera.height, tile_rows):
+            # the rays are float32, the depth range denominators need float64 to stay away from 0
+            ref_pos = pixel_rays(camera, row_begin, min(row_begin + tile_rows, camera.height))
+            src_pos = np.matmul(ref_pos, R.T)
             projection = src_pos[..., :2] / src_pos[..., 2:3]
 
             direction = centor[None, None, :] - projection
@@ -480,36 +534,74 @@ def disparity_compute(cameras, images, points3D):
             if T[2] > 0.:
                 disparity_range[..., 1:2] = np.minimum(disparity_range[..., 1:2], distance)
 
-            disparity_range_ = distance / np.abs(1. + depth_range * src_pos[..., 2:3] / T[2])
-            disparity_range_ = np.sort(disparity_range_, axis=-1)
-            err = np.abs(disparity_range_ - disparity_range)
-            err = np.where(depth_range[..., 0:1] > depth_range[..., 1:2], 0., err)
-
-            resolution = (camera.max_w - camera.min_w)/camera.width
+            valid = depth_range[..., 0] <= depth_range[..., 1]
+            if np.any(valid):
+                min_depth = min(min_depth, float(np.min(depth_range[..., 0][valid])))
+                max_depth = max(max_depth, float(np.max(depth_range[..., 1][valid])))
+                max_disparity = max(max_disparity,
+                                    float(np.max((disparity_range[..., 1] - disparity_range[..., 0])[valid])))
+        results.append((image_id_y, min_depth, max_depth, max_disparity))
+    return image_id, results
+
+
+def disparity_compute(cameras, images, view_selection, num_processes=1, num_neighbors=10, tile_rows=64):
+    """Depth range (and widest disparity range) of every image against its
+    num_neighbors best scored views of view_selection (mvsnet_view_select), over
+    all pixels, {image_id: [(image_id_y, min_depth, max_depth, max_disparity)]}.
+    Pixels are processed tile_rows rows at a time, images are spread over
+    num_processes processes."""
+    global _disparity_state
+    scores = pair_scores_to_dict(view_selection)
+    image_depth_range = depth_samples_to_dict(view_selection)
+
+    image_ids = list(images.keys())
+    _disparity_state = (cameras, images, scores, num_neighbors, tile_rows)
+    try:
+        if num_processes > 1 and len(image_ids) > 1:
+            with mp.Pool(min(num_processes, len(image_ids)), initializer=_init_disparity_state,
+                         initargs=_disparity_state) as pool:
+                results = dict(pool.imap(_disparity_image, image_ids))
+        else:
+            results = dict(map(_disparity_image, image_ids))
+    finally:
+        _disparity_state = None
 
-            # disparity_width = np.where(disparity_range[..., 1] > disparity_range[..., 0], disparity_range[..., 1] - disparity_range[..., 0], 0.)
-            # depth_width = np.where(depth_range[..., 1] > depth_range[..., 0], depth_range[..., 1] - depth_range[..., 0], 0,)
-            # show_3d_suface(disparity_width, block=False)
-            # show_3d_suface(depth_width)
-            print(i, end=' ')
-            print(np.min(np.where(depth_range[..., 0] > depth_range[..., 1], np.PINF, depth_range[..., 0])), end=' ')
-            print(np.max(np.where(depth_range[..., 0] > depth_range[..., 1], np.NINF, depth_range[..., 1])), end=' ')
-            print(image_depth_range[image_id][int(len(image_depth_range[image_id]) * 0.01)])
+    for image_id in image_ids:
+        sfm_depths = image_depth_range[image_id]
+        for i, (image_id_y, min_depth, max_depth, max_disparity) in enumerate(results[image_id]):
+            logging.info('%d %d -> %d: depth range [%f, %f], max disparity %f, sfm 1%% depth %f', i, image_id,
+                         image_id_y, min_depth, max_depth, max_disparity, sfm_depths[int(len(sfm_depths) * 0.01)])
+    return results
 
 if __name__ == '__main__':
     InitLogging()
 
     parser = argparse.ArgumentParser()
     parser.add_argument('sfm_path', help='sfm reconstruction result directory')
+    parser.add_argument('--model_cache', action='store_true', help='cache the decoded model for later runs')
+    parser.add_argument('--json_path', default=None,
+                        help='where the statistics are written, default <sfm_path>/sfm_statistics.json')
+    parser.add_argument('--streaming', action='store_true',
+                        help='bounded memory statistics, quantiles from mergeable sketches (approximate)')
+    parser.add_argument('--disparity', action='store_true', help='also run the per pixel depth / disparity analysis')
+    parser.add_argument('--artifact_dir', default=None,
+                        help='where intermediate results are kept, default <sfm_path>/.artifacts')
+    parser.add_argument('--num_cpu', type=int, default=os.cpu_count(), help='processes used for the statistics')
     options = parser.parse_args()
 
-    cameras, images, points3D = read_model(options.sfm_path, '.bin')
+    model = ColmapModel.read(options.sfm_path, '.bin', cache=options.model_cache)
+    cameras, images, points3D = model.dict_views()
     logging.info('Num views: %d', len(images))
     logging.info('Num 3D points: %d', len(points3D))
     new_cameras = format_camera(cameras)
     format_images(images)
-    # PrintReprojectionErrors(new_cameras, images, points3D)
-    # PrintTrackLengthHistogram(new_cameras, images, points3D)
-    # colmap_view_select(new_cameras, images, points3D)
-    # mvsnet_view_select(new_cameras, images, points3D)
-    disparity_compute(new_cameras, images, points3D)
+    statistics = compute_statistics(new_cameras, model, options.num_cpu, options.streaming)
+    write_statistics(statistics, options.json_path or os.path.join(options.sfm_path, 'sfm_statistics.json'))
+    logging.info('Num observations: %d, mean track length: %s, mean / median reprojection error: %s / %s',
+                 statistics['num_observations'], statistics['track_length']['mean'],
+                 statistics['reprojection_error']['mean'], statistics['reprojection_error']['median'])
+    if options.disparity:
+        store = ArtifactStore(options.artifact_dir or os.path.join(options.sfm_path, '.artifacts'))
+        model_key = {'model': model_digest(options.sfm_path, '.bin')}
+        view_selection = store.load_or_compute('mvsnet_view_select', model_key, lambda: mvsnet_view_select(model))
+        disparity_compute(new_cameras, images, view_selection, options.num_cpu)
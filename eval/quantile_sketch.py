@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+
+
+class KLLSketch:
+    """Mergeable streaming quantile sketch (KLL, Karnin, Lang and Liberty 2016).
+
+    Values are kept in compactor levels, an item of level h stands for 2^h
+    input values. When a level holds more than its capacity it is sorted and
+    every other item (random offset) moves up one level. Memory is O(k) items
+    whatever the number of values; with the default k=200 the rank error of a
+    single quantile query is about 1.65% of the count with 99% confidence
+    (the error scales like 1/k). Sketches built on different chunks or in
+    different processes can be merged, the merged sketch has the same
+    guarantees as one built on all the values.
+    """
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (2. / 3.) ** depth)), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(self.levels[level])
+                # an odd item out stays on its level
+                kept, items = items[:len(items) % 2], items[len(items) % 2:]
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[self._rng.integers(2)::2]])
+            level += 1
+
+    def update(self, values):
+        """Add an array of values, NaNs are ignored."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.count += len(values)
+        self._compress()
+
+    def merge(self, other):
+        """Add all values of another sketch."""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def _weighted_items(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_items), 1 << level, dtype=np.int64)
+                                  for level, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        return items[order], np.cumsum(weights[order])
+
+    def quantile(self, q):
+        """Approximate q-quantile(s) (nearest rank), nan if the sketch is empty."""
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan) if q.ndim else float('nan')
+        items, cum_weights = self._weighted_items()
+        ranks = np.minimum(np.floor(q * cum_weights[-1]).astype(np.int64), cum_weights[-1] - 1)
+        result = items[np.searchsorted(cum_weights, ranks, side='right')]
+        return result if q.ndim else float(result)
+
+    def rank(self, value):
+        """Approximate fraction of the values <= value."""
+        if self.count == 0:
+            return float('nan')
+        items, cum_weights = self._weighted_items()
+        pos = np.searchsorted(items, value, side='right')
+        return float(cum_weights[pos - 1] / cum_weights[-1]) if pos > 0 else 0.
+
+    @property
+    def num_retained(self):
+        return sum(len(level_items) for level_items in self.levels)
@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import stat
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+
+class ArtifactStore:
+    """Intermediate results (named groups of numpy arrays) under a workspace directory.
+
+    An artifact is stored in <root>/<name>/<sha1 of its key>/, one .npy file per
+    array plus key.json. The key is a json-able dict, normally the model digest
+    (colmap_model.model_digest) and the parameters the artifact depends on, so
+    different scenes and settings never collide and reruns with the same key
+    load the arrays (mmapped) instead of recomputing them.
+
+    Directory artifacts (whole conversion outputs) are stored the same way,
+    their files under <root>/<name>/<sha1 of its key>/data. They are linked
+    into the targets (pipeline.utils.LinkTree), so the stored files are made
+    read-only and a target file is only rewritten after
+    pipeline.utils.DetachFile.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _artifact_dir(self, name, key):
+        key_str = json.dumps(key, sort_keys=True)
+        return os.path.join(self.root, name, hashlib.sha1(key_str.encode()).hexdigest())
+
+    def load(self, name, key, mmap_mode='r'):
+        """{array name: array} of the artifact, None if it was never saved."""
+        artifact_dir = self._artifact_dir(name, key)
+        key_path = os.path.join(artifact_dir, 'key.json')
+        if not os.path.isfile(key_path):
+            return None
+        with open(key_path, 'r') as f:
+            saved = json.load(f)
+        if saved['key'] != json.loads(json.dumps(key, sort_keys=True)):
+            logging.warning('artifact %s has a different key, ignore it', artifact_dir)
+            return None
+        logging.info('load %s from %s', name, artifact_dir)
+        return {array_name: np.load(os.path.join(artifact_dir, array_name + '.npy'), mmap_mode=mmap_mode)
+                for array_name in saved['arrays']}
+
+    def save(self, name, key, arrays):
+        artifact_dir = self._artifact_dir(name, key)
+        tmp_dir = artifact_dir + '.tmp%d' % os.getpid()
+        try:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            for array_name, value in arrays.items():
+                np.save(os.path.join(tmp_dir, array_name + '.npy'), np.asarray(value))
+            with open(os.path.join(tmp_dir, 'key.json'), 'w') as f:
+                json.dump({'key': key, 'arrays': sorted(arrays.keys())}, f, sort_keys=True)
+            shutil.rmtree(artifact_dir, ignore_errors=True)
+            os.rename(tmp_dir, artifact_dir)
+        except OSError as e:
+            logging.warning('can not save artifact %s: %s', artifact_dir, e)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def load_or_compute(self, name, key, compute_fun):
+        """Saved arrays of the artifact, or compute_fun() saved first."""
+        arrays = self.load(name, key)
+        if arrays is None:
+            arrays = compute_fun()
+            self.save(name, key, arrays)
+        return arrays
+
+    def load_directory(self, name, key):
+        """data directory of a directory artifact, None if it was never built."""
+        artifact_dir = self._artifact_dir(name, key)
+        key_path = os.path.join(artifact_dir, 'key.json')
+        if not os.path.isfile(key_path):
+            return None
+        with open(key_path, 'r') as f:
+            saved = json.load(f)
+        if saved['key'] != json.loads(json.dumps(key, sort_keys=True)):
+            logging.warning('artifact %s has a different key, ignore it', artifact_dir)
+            return None
+        return os.path.join(artifact_dir, 'data')
+
+    @staticmethod
+    def _make_read_only(data_dir):
+        write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+        for root, _, files in os.walk(data_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                mode = os.stat(path).st_mode
+                if mode & write_bits:
+                    os.chmod(path, mode & ~write_bits)
+
+    def load_or_build_directory(self, name, key, build_fun):
+        """data directory of a directory artifact, build_fun(data directory)
+        fills it first if it was never built. A failed build leaves nothing."""
+        data_dir = self.load_directory(name, key)
+        if data_dir is not None:
+            logging.info('reuse %s from %s', name, data_dir)
+            self._make_read_only(data_dir)
+            return data_dir
+        artifact_dir = self._artifact_dir(name, key)
+        tmp_dir = artifact_dir + '.tmp%d' % os.getpid()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(os.path.join(tmp_dir, 'data'))
+        try:
+            build_fun(os.path.join(tmp_dir, 'data'))
+            self._make_read_only(os.path.join(tmp_dir, 'data'))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        with open(os.path.join(tmp_dir, 'key.json'), 'w') as f:
+            json.dump({'key': key}, f, sort_keys=True)
+        shutil.rmtree(artifact_dir, ignore_errors=True)
+        os.rename(tmp_dir, artifact_dir)
+        return os.path.join(artifact_dir, 'data')
@@ -0,0 +1,263 @@
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+
+from pipeline.utils import LogThanExitIfFailed
+from third_party.colmap.read_write_model import CAMERA_MODEL_NAMES
+
+EPSILON = np.finfo(np.float64).eps
+
+
+class CameraModel:
+    """One COLMAP camera (see CAMERA_MODELS in read_write_model), batched.
+
+    uv are normalized image coordinates (x / z, y / z) and xy pixel
+    coordinates, both (N, 2) arrays. distort/undistort map between undistorted
+    and distorted normalized coordinates, the same conventions as COLMAP's
+    camera models (models.h). Subclasses with distortion implement
+    _distortion(u, v) -> (du, dv); undistort inverts it with Newton steps.
+    """
+    model_name = None
+    # params layout: focal length(s), principal point, then extra params
+    focal_length_idxs = (0, 1)
+    principal_point_idxs = (2, 3)
+    has_distortion = True
+
+    def __init__(self, params, width=0, height=0):
+        LogThanExitIfFailed(len(params) == CAMERA_MODEL_NAMES[self.model_name].num_params,
+                            '%s expects %d params, got %d', self.model_name,
+                            CAMERA_MODEL_NAMES[self.model_name].num_params, len(params))
+        self.params = np.asarray(params, dtype=np.float64)
+        self.width = width
+        self.height = height
+        self.fx = self.params[self.focal_length_idxs[0]]
+        self.fy = self.params[self.focal_length_idxs[-1]]
+        self.cx = self.params[self.principal_point_idxs[0]]
+        self.cy = self.params[self.principal_point_idxs[1]]
+        self.extra_params = self.params[self.principal_point_idxs[1] + 1:]
+        self.K = np.array([[self.fx, 0, self.cx], [0, self.fy, self.cy], [0, 0, 1]])
+        self.K_inv = np.linalg.inv(self.K)
+
+    def _distortion(self, u, v):
+        return np.zeros_like(u), np.zeros_like(v)
+
+    def distort(self, uv):
+        uv = np.asarray(uv, dtype=np.float64)
+        if not self.has_distortion:
+            return uv.copy()
+        du, dv = self._distortion(uv[..., 0], uv[..., 1])
+        return np.stack((uv[..., 0] + du, uv[..., 1] + dv), axis=-1)
+
+    def undistort(self, uv, max_iterations=100, max_step_norm=1e-10, rel_step_size=1e-6):
+        """Inverse of distort, Newton iterations with a numerical Jacobian
+        (COLMAP's IterativeUndistortion) on all points at once; points stop
+        iterating once their step is small enough."""
+        uv = np.asarray(uv, dtype=np.float64)
+        if not self.has_distortion:
+            return uv.copy()
+        shape = uv.shape
+        x0 = uv.reshape(-1, 2)
+        x = x0.copy()
+        active = np.arange(len(x))
+        for _ in range(max_iterations):
+            if len(active) == 0:
+                break
+            xa = x[active]
+            step = np.maximum(EPSILON, np.abs(rel_step_size * xa))
+            du, dv = self._distortion(xa[:, 0], xa[:, 1])
+            du_0b, dv_0b = self._distortion(xa[:, 0] - step[:, 0], xa[:, 1])
+            du_0f, dv_0f = self._distortion(xa[:, 0] + step[:, 0], xa[:, 1])
+            du_1b, dv_1b = self._distortion(xa[:, 0], xa[:, 1] - step[:, 1])
+            du_1f, dv_1f = self._distortion(xa[:, 0], xa[:, 1] + step[:, 1])
+            j00 = 1 + (du_0f - du_0b) / (2 * step[:, 0])
+            j01 = (du_1f - du_1b) / (2 * step[:, 1])
+            j10 = (dv_0f - dv_0b) / (2 * step[:, 0])
+            j11 = 1 + (dv_1f - dv_1b) / (2 * step[:, 1])
+            r0 = xa[:, 0] + du - x0[active, 0]
+            r1 = xa[:, 1] + dv - x0[active, 1]
+            det = j00 * j11 - j01 * j10
+            step_x = (j11 * r0 - j01 * r1) / det
+            step_y = (j00 * r1 - j10 * r0) / det
+            x[active, 0] -= step_x
+            x[active, 1] -= step_y
+            active = active[~(step_x * step_x + step_y * step_y < max_step_norm)]
+        return x.reshape(shape)
+
+    def __call__(self, uv):
+        """Pixel coordinates of the undistorted normalized coordinates uv."""
+        xy = self.distort(uv)
+        return np.stack((xy[..., 0] * self.fx + self.cx, xy[..., 1] * self.fy + self.cy), axis=-1)
+
+    def project(self, points):
+        """Pixel coordinates of (N, 3) points in the camera frame."""
+        points = np.asarray(points, dtype=np.float64)
+        return self(points[..., :2] / points[..., 2:3])
+
+    def image_to_world(self, xy):
+        """Undistorted normalized coordinates of the pixels xy."""
+        xy = np.asarray(xy, dtype=np.float64)
+        uv = np.stack(((xy[..., 0] - self.cx) / self.fx, (xy[..., 1] - self.cy) / self.fy), axis=-1)
+        return self.undistort(uv)
+
+
+class SimplePinholeCamera(CameraModel):
+    model_name = 'SIMPLE_PINHOLE'
+    focal_length_idxs = (0,)
+    principal_point_idxs = (1, 2)
+    has_distortion = False
+
+
+class PinholeCamera(CameraModel):
+    model_name = 'PINHOLE'
+    has_distortion = False
+
+
+class SimpleRadialCamera(CameraModel):
+    model_name = 'SIMPLE_RADIAL'
+    focal_length_idxs = (0,)
+    principal_point_idxs = (1, 2)
+
+    def _distortion(self, u, v):
+        k = self.extra_params[0]
+        radial = k * (u * u + v * v)
+        return u * radial, v * radial
+
+
+class RadialCamera(CameraModel):
+    model_name = 'RADIAL'
+    focal_length_idxs = (0,)
+    principal_point_idxs = (1, 2)
+
+    def _distortion(self, u, v):
+        k1, k2 = self.extra_params
+        r2 = u * u + v * v
+        radial = k1 * r2 + k2 * r2 * r2
+        return u * radial, v * radial
+
+
+class OpenCVCamera(CameraModel):
+    model_name = 'OPENCV'
+
+    def _distortion(self, u, v):
+        k1, k2, p1, p2 = self.extra_params
+        u2 = u * u
+        uv = u * v
+        v2 = v * v
+        r2 = u2 + v2
+        radial = k1 * r2 + k2 * r2 * r2
+        return (u * radial + 2. * p1 * uv + p2 * (r2 + 2. * u2),
+                v * radial + 2. * p2 * uv + p1 * (r2 + 2. * v2))
+
+
+def _fisheye_theta_d(u, v, radial_coefs):
+    """(theta_d / r, r > eps) of the equidistant fisheye models, theta_d = theta * (1 + sum(k_i * theta^(2i)))."""
+    r = np.sqrt(u * u + v * v)
+    valid = r > EPSILON
+    theta = np.arctan(r)
+    theta2 = theta * theta
+    coef = np.ones_like(theta)
+    theta_pow = np.ones_like(theta)
+    for k in radial_coefs:
+        theta_pow = theta_pow * theta2
+        coef = coef + k * theta_pow
+    scale = np.divide(theta * coef, r, out=np.ones_like(r), where=valid)
+    return scale, valid
+
+
+class OpenCVFisheyeCamera(CameraModel):
+    model_name = 'OPENCV_FISHEYE'
+
+    def _distortion(self, u, v):
+        scale, valid = _fisheye_theta_d(u, v, self.extra_params)
+        return np.where(valid, u * scale - u, 0.), np.where(valid, v * scale - v, 0.)
+
+
+class FullOpenCVCamera(CameraModel):
+    model_name = 'FULL_OPENCV'
+
+    def _distortion(self, u, v):
+        k1, k2, p1, p2, k3, k4, k5, k6 = self.extra_params
+        u2 = u * u
+        uv = u * v
+        v2 = v * v
+        r2 = u2 + v2
+        r4 = r2 * r2
+        r6 = r4 * r2
+        radial = (1. + k1 * r2 + k2 * r4 + k3 * r6) / (1. + k4 * r2 + k5 * r4 + k6 * r6)
+        return (u * radial + 2. * p1 * uv + p2 * (r2 + 2. * u2) - u,
+                v * radial + 2. * p2 * uv + p1 * (r2 + 2. * v2) - v)
+
+
+class FOVCamera(CameraModel):
+    """Field of view model, its distortion is a radial factor with a closed form inverse."""
+    model_name = 'FOV'
+
+    def _factor(self, uv, inverse):
+        omega = self.extra_params[0]
+        radius2 = uv[..., 0] * uv[..., 0] + uv[..., 1] * uv[..., 1]
+        omega2 = omega * omega
+        if omega2 < 1e-4:
+            # second order Taylor expansion in omega
+            if inverse:
+                return (omega2 * radius2) / 3. - omega2 / 12. + 1.
+            return omega2 / 12. - (omega2 * radius2) / 3. + 1.
+        tan_half_omega = np.tan(omega / 2.)
+        radius = np.sqrt(radius2)
+        small = radius2 < 1e-4
+        safe_radius = np.where(small, 1., radius)
+        if inverse:
+            factor = np.tan(safe_radius * omega) / (safe_radius * 2. * tan_half_omega)
+            taylor = (omega * (omega2 * radius2 + 3.)) / (6. * tan_half_omega)
+        else:
+            factor = np.arctan(safe_radius * 2. * tan_half_omega) / (safe_radius * omega)
+            taylor = (-2. * tan_half_omega * (4. * radius2 * tan_half_omega * tan_half_omega - 3.)) / (3. * omega)
+        return np.where(small, taylor, factor)
+
+    def distort(self, uv):
+        uv = np.asarray(uv, dtype=np.float64)
+        return uv * self._factor(uv, inverse=False)[..., None]
+
+    def undistort(self, uv, **kwargs):
+        uv = np.asarray(uv, dtype=np.float64)
+        return uv * self._factor(uv, inverse=True)[..., None]
+
+
+class SimpleRadialFisheyeCamera(CameraModel):
+    model_name = 'SIMPLE_RADIAL_FISHEYE'
+    focal_length_idxs = (0,)
+    principal_point_idxs = (1, 2)
+
+    def _distortion(self, u, v):
+        scale, valid = _fisheye_theta_d(u, v, self.extra_params)
+        return np.where(valid, u * scale - u, 0.), np.where(valid, v * scale - v, 0.)
+
+
+class RadialFisheyeCamera(SimpleRadialFisheyeCamera):
+    model_name = 'RADIAL_FISHEYE'
+
+
+class ThinPrismFisheyeCamera(CameraModel):
+    model_name = 'THIN_PRISM_FISHEYE'
+
+    def _distortion(self, u, v):
+        k1, k2, p1, p2, k3, k4, sx1, sy1 = self.extra_params
+        scale, valid = _fisheye_theta_d(u, v, (k1, k2, k3, k4))
+        uu = np.where(valid, u * scale, u)
+        vv = np.where(valid, v * scale, v)
+        uu2 = uu * uu
+        uv = uu * vv
+        vv2 = vv * vv
+        r2 = uu2 + vv2
+        return (uu + 2. * p1 * uv + p2 * (r2 + 2. * uu2) + sx1 * r2 - u,
+                vv + 2. * p2 * uv + p1 * (r2 + 2. * vv2) + sy1 * r2 - v)
+
+
+CAMERA_MODEL_CLASSES = dict([(camera_class.model_name, camera_class) for camera_class in [
+    SimplePinholeCamera, PinholeCamera, SimpleRadialCamera, RadialCamera, OpenCVCamera, OpenCVFisheyeCamera,
+    FullOpenCVCamera, FOVCamera, SimpleRadialFisheyeCamera, RadialFisheyeCamera, ThinPrismFisheyeCamera]])
+
+
+def camera_from_colmap(camera):
+    """CameraModel of a read_write_model Camera."""
+    LogThanExitIfFailed(camera.model in CAMERA_MODEL_CLASSES, 'unsupport camera type: %s', camera.model)
+    return CAMERA_MODEL_CLASSES[camera.model](camera.params, camera.width, camera.height)
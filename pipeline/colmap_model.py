@@ -0,0 +1,566 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import mmap
+import json
+import shutil
+import struct
+import hashlib
+import tempfile
+import logging
+import collections
+from collections.abc import Mapping
+import numpy as np
+
+from third_party.colmap.read_write_model import Image, Point3D, CAMERA_MODEL_NAMES, \
+    ImagesArrays, Points3DArrays, write_model, read_cameras_binary, read_cameras_text, read_images_binary_arrays, \
+    read_points3d_binary_arrays, read_images_text_arrays, read_points3D_text_arrays, images_dict_to_arrays, \
+    points3d_dict_to_arrays, \
+    IMAGE_HEADER_DTYPE, POINT2D_DTYPE, POINT3D_HEADER_DTYPE, TRACK_ELEM_DTYPE, qvecs2rotmats, \
+    _points3d_record_offsets
+
+# per image rotation (N, 3, 3), translation (N, 3), camera center (N, 3) and projection matrix K [R|t] (N, 3, 4)
+PoseTable = collections.namedtuple("PoseTable", ["R", "t", "centers", "P"])
+
+# models whose params start with a single focal length (f, cx, cy, ...), the others start with fx, fy, cx, cy
+SINGLE_FOCAL_MODEL_IDS = [CAMERA_MODEL_NAMES[name].model_id for name in
+                          ["SIMPLE_PINHOLE", "SIMPLE_RADIAL", "RADIAL", "SIMPLE_RADIAL_FISHEYE", "RADIAL_FISHEYE"]]
+
+
+class ImagesView(Mapping):
+    """dict-like {image_id: Image} view of a ColmapModel.
+
+    Image objects are created on first access and kept, so attributes attached
+    to them (e.g. by format_images) survive; there are only a few thousand.
+    """
+
+    def __init__(self, model):
+        self._model = model
+        self._images = {}
+
+    def __getitem__(self, image_id):
+        image = self._images.get(image_id)
+        if image is None:
+            row = self._model.image_rows[image_id]
+            arrays = self._model.images_arrays
+            begin, end = arrays.point2D_offsets[row], arrays.point2D_offsets[row + 1]
+            image = Image(id=int(arrays.ids[row]), qvec=arrays.qvecs[row], tvec=arrays.tvecs[row],
+                          camera_id=int(arrays.camera_ids[row]), name=arrays.names[row],
+                          xys=arrays.xys[begin:end], point3D_ids=arrays.point3D_ids[begin:end])
+            self._images[image.id] = image
+        return image
+
+    def __iter__(self):
+        return iter(self._model.images_arrays.ids.tolist())
+
+    def __len__(self):
+        return len(self._model.images_arrays.ids)
+
+
+class Points3DView(Mapping):
+    """dict-like {point3D_id: Point3D} view of a ColmapModel.
+
+    Point3D objects are built on access and not kept. Their track arrays are
+    views into the model CSR arrays, so in place edits go to the model.
+    """
+
+    def __init__(self, model):
+        self._model = model
+
+    def _point3D(self, row):
+        arrays = self._model.points3D_arrays
+        begin, end = arrays.track_offsets[row], arrays.track_offsets[row + 1]
+        return Point3D(id=int(arrays.ids[row]), xyz=arrays.xyzs[row], rgb=arrays.rgbs[row],
+                       error=arrays.errors[row], image_ids=arrays.track_image_ids[begin:end],
+                       point2D_idxs=arrays.track_point2D_idxs[begin:end])
+
+    def __getitem__(self, point3D_id):
+        rows = self._model.point3D_rows(np.array([point3D_id]))
+        if rows[0] < 0:
+            raise KeyError(point3D_id)
+        return self._point3D(rows[0])
+
+    def __iter__(self):
+        return iter(self._model.points3D_arrays.ids.tolist())
+
+    def __len__(self):
+        return len(self._model.points3D_arrays.ids)
+
+    def items(self):
+        for row, point3D_id in enumerate(self._model.points3D_arrays.ids.tolist()):
+            yield point3D_id, self._point3D(row)
+
+    def values(self):
+        for row in range(len(self)):
+            yield self._point3D(row)
+
+
+class ColmapModel:
+    """Columnar (structure of arrays) COLMAP sparse model.
+
+    Poses, keypoints, point positions and tracks live in a few contiguous
+    arrays (ImagesArrays / Points3DArrays, tracks and keypoints as CSR) instead
+    of one namedtuple per image and per point. cameras/images/points3D are
+    dict compatible views for code written against read_model.
+    """
+
+    def __init__(self, cameras, images_arrays: ImagesArrays, points3D_arrays: Points3DArrays):
+        self.cameras = cameras
+        self.images_arrays = images_arrays
+        self.points3D_arrays = points3D_arrays
+
+        self.camera_ids = np.array(sorted(cameras.keys()), dtype=np.int64)
+        max_num_params = max([len(cameras[camera_id].params) for camera_id in cameras] + [0])
+        self.camera_model_ids = np.empty(len(cameras), dtype=np.int64)
+        self.camera_widths = np.empty(len(cameras), dtype=np.int64)
+        self.camera_heights = np.empty(len(cameras), dtype=np.int64)
+        self.camera_params = np.full((len(cameras), max_num_params), np.nan)
+        for row, camera_id in enumerate(self.camera_ids.tolist()):
+            camera = cameras[camera_id]
+            self.camera_model_ids[row] = CAMERA_MODEL_NAMES[camera.model].model_id
+            self.camera_widths[row] = camera.width
+            self.camera_heights[row] = camera.height
+            self.camera_params[row, :len(camera.params)] = camera.params
+        self.camera_rows = {camera_id: row for row, camera_id in enumerate(self.camera_ids.tolist())}
+
+        self.image_rows = {image_id: row for row, image_id in enumerate(images_arrays.ids.tolist())}
+        self._point3D_order = np.argsort(points3D_arrays.ids, kind='stable')
+        self._sorted_point3D_ids = points3D_arrays.ids[self._point3D_order]
+        self._image_observations = None
+        self._image_row_lookup = None
+        self._poses = None
+
+        self.images = ImagesView(self)
+        self.points3D = Points3DView(self)
+
+    @classmethod
+    def read(cls, path, ext, cache=False, cache_dir=None):
+        """Read the model in path. With cache=True the decoded arrays are kept
+        in cache_dir (default <path>/.model_cache) and later reads of the same,
+        unchanged files only mmap them, see ModelCache."""
+        if cache:
+            model_cache = ModelCache(path, ext, cache_dir)
+            model = model_cache.load()
+            if model is None:
+                model = cls._read(path, ext)
+                model_cache.save(model)
+            return model
+        return cls._read(path, ext)
+
+    @classmethod
+    def _read(cls, path, ext):
+        if ext == '.bin':
+            return cls(read_cameras_binary(os.path.join(path, 'cameras' + ext)),
+                       read_images_binary_arrays(os.path.join(path, 'images' + ext)),
+                       read_points3d_binary_arrays(os.path.join(path, 'points3D' + ext)))
+        return cls(read_cameras_text(os.path.join(path, 'cameras' + ext)),
+                   read_images_text_arrays(os.path.join(path, 'images' + ext)),
+                   read_points3D_text_arrays(os.path.join(path, 'points3D' + ext)))
+
+    @classmethod
+    def from_dicts(cls, cameras, images, points3D):
+        return cls(dict(cameras), images_dict_to_arrays(images), points3d_dict_to_arrays(points3D))
+
+    def dict_views(self):
+        """Same (cameras, images, points3D) triple as read_model, backed by this model."""
+        return self.cameras, self.images, self.points3D
+
+    def write(self, path, ext):
+        write_model(self.cameras, self.images_arrays, self.points3D_arrays, path, ext)
+
+    @property
+    def num_images(self):
+        return len(self.images_arrays.ids)
+
+    @property
+    def num_points3D(self):
+        return len(self.points3D_arrays.ids)
+
+    @property
+    def track_lengths(self):
+        return np.diff(self.points3D_arrays.track_offsets)
+
+    def camera_matrices(self):
+        """Calibration matrix K of every camera row, (C, 3, 3)."""
+        single = np.isin(self.camera_model_ids, SINGLE_FOCAL_MODEL_IDS)
+        params = np.full((len(self.camera_ids), 4), np.nan)
+        num_params = min(self.camera_params.shape[1], 4)
+        params[:, :num_params] = self.camera_params[:, :num_params]
+        K = np.zeros((len(self.camera_ids), 3, 3))
+        K[:, 0, 0] = params[:, 0]
+        K[:, 1, 1] = np.where(single, params[:, 0], params[:, 1])
+        K[:, 0, 2] = np.where(single, params[:, 1], params[:, 2])
+        K[:, 1, 2] = np.where(single, params[:, 2], params[:, 3])
+        K[:, 2, 2] = 1
+        return K
+
+    def image_camera_rows(self):
+        """Camera row of every image row."""
+        return np.array([self.camera_rows[camera_id] for camera_id in self.images_arrays.camera_ids.tolist()],
+                        dtype=np.int64)
+
+    @property
+    def poses(self):
+        """PoseTable of all images in image row order, computed once per model."""
+        if self._poses is None:
+            R = qvecs2rotmats(self.images_arrays.qvecs)
+            t = np.asarray(self.images_arrays.tvecs, dtype=np.float64)
+            centers = -np.einsum('nji,nj->ni', R, t)
+            Rt = np.concatenate([R, t[:, :, None]], axis=2)
+            P = np.matmul(self.camera_matrices()[self.image_camera_rows()], Rt)
+            self._poses = PoseTable(R, t, centers, P)
+        return self._poses
+
+    def pose(self, image_id):
+        """(R, t, center, P) of image_id, rows of the pose table."""
+        row = self.image_rows[image_id]
+        return PoseTable(*[values[row] for values in self.poses])
+
+    def point3D_rows(self, point3D_ids):
+        """Row of every id in point3D_ids, -1 if the point does not exist."""
+        point3D_ids = np.asarray(point3D_ids)
+        if len(self._sorted_point3D_ids) == 0:
+            return np.full(point3D_ids.shape, -1, dtype=np.int64)
+        pos = np.searchsorted(self._sorted_point3D_ids, point3D_ids)
+        pos = np.minimum(pos, len(self._sorted_point3D_ids) - 1)
+        return np.where(self._sorted_point3D_ids[pos] == point3D_ids, self._point3D_order[pos], -1)
+
+    def track_point3D_rows(self):
+        """Point row of every element of the flat track arrays."""
+        return np.repeat(np.arange(self.num_points3D, dtype=np.int64), self.track_lengths)
+
+    def image_rows_of(self, image_ids):
+        """Row of every id in image_ids, the ids must exist."""
+        if self._image_row_lookup is None:
+            self._image_row_lookup = np.full(int(max(self.image_rows.keys(), default=0)) + 1, -1, dtype=np.int64)
+            self._image_row_lookup[self.images_arrays.ids] = np.arange(self.num_images)
+        return self._image_row_lookup[image_ids]
+
+    def track_image_rows(self):
+        """Image row of every element of the flat track arrays."""
+        return self.image_rows_of(self.points3D_arrays.track_image_ids)
+
+    def image_observations(self, image_id):
+        """Flat track positions of all observations made by image_id (the image -> track reverse index)."""
+        if self._image_observations is None:
+            image_rows = self.track_image_rows()
+            offsets = np.zeros(self.num_images + 1, dtype=np.int64)
+            np.cumsum(np.bincount(image_rows, minlength=self.num_images), out=offsets[1:])
+            self._image_observations = (offsets, np.argsort(image_rows, kind='stable'))
+        offsets, order = self._image_observations
+        row = self.image_rows[image_id]
+        return order[offsets[row]:offsets[row + 1]]
+
+
+def _file_sha1(filepath, block_size=1 << 24):
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ModelCache:
+    """Decoded-model cache of one sparse model directory.
+
+    The arrays of a ColmapModel are stored as .npy files and loaded back with
+    mmap, so a cached read costs disk bandwidth only. The manifest records
+    size, mtime and sha1 of cameras/images/points3D: if size and mtime still
+    match the cache is used as is, if only the mtime changed the files are
+    hashed and the cache is kept when the content is the same, otherwise it
+    is rebuilt on the next save.
+
+    Every save writes its arrays to a new arrays-* directory and then swaps
+    manifest.json with os.replace, so concurrent runs never see a half
+    written cache; a run losing a race, or finding its arrays removed, just
+    reads the model without the cache.
+    """
+
+    VERSION = 2
+    MODEL_FILES = ('cameras', 'images', 'points3D')
+    ARRAY_FIELDS = {'images': ImagesArrays, 'points3D': Points3DArrays}
+    ARRAYS_PREFIX = 'arrays-'
+
+    def __init__(self, path, ext, cache_dir=None):
+        self.path = path
+        self.ext = ext
+        self.cache_dir = cache_dir or os.path.join(path, '.model_cache')
+
+    def _source_files(self):
+        return {name: os.path.join(self.path, name + self.ext) for name in self.MODEL_FILES}
+
+    def _manifest_path(self):
+        return os.path.join(self.cache_dir, 'manifest.json')
+
+    def _write_manifest(self, manifest):
+        fd, tmp_path = tempfile.mkstemp(prefix='manifest-', suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self._manifest_path())
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+    def _is_valid(self, manifest):
+        if manifest.get('version') != self.VERSION or manifest.get('ext') != self.ext:
+            return False
+        touched = False
+        for name, filepath in self._source_files().items():
+            entry = manifest['files'].get(name)
+            try:
+                file_stat = os.stat(filepath)
+            except FileNotFoundError:
+                return False
+            if entry is None or entry['size'] != file_stat.st_size:
+                return False
+            if entry['mtime_ns'] != file_stat.st_mtime_ns:
+                if entry['sha1'] != _file_sha1(filepath):
+                    return False
+                entry['mtime_ns'] = file_stat.st_mtime_ns
+                touched = True
+        if touched:
+            # same content with a new mtime, remember it to skip hashing next time
+            try:
+                self._write_manifest(manifest)
+            except OSError:
+                pass
+        return True
+
+    def load(self):
+        """ColmapModel backed by mmapped cache arrays, None if there is no valid cache."""
+        try:
+            with open(self._manifest_path(), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not self._is_valid(manifest):
+            logging.info('model cache %s is out of date', self.cache_dir)
+            return None
+        arrays_dir = os.path.join(self.cache_dir, manifest['arrays_dir'])
+
+        def load_array(name):
+            # copy on write, so callers can still edit the arrays in memory
+            return np.load(os.path.join(arrays_dir, name + '.npy'), mmap_mode='c')
+
+        arrays = {}
+        try:
+            for kind, fields_type in self.ARRAY_FIELDS.items():
+                fields = {field: load_array(kind + '_' + field) for field in fields_type._fields}
+                if 'names' in fields:
+                    fields['names'] = fields['names'].tolist()
+                arrays[kind] = fields_type(**fields)
+        except (OSError, ValueError) as e:
+            # replaced by a concurrent save
+            logging.info('model cache %s can not be loaded: %s', self.cache_dir, e)
+            return None
+        cameras_path = self._source_files()['cameras']
+        cameras = read_cameras_text(cameras_path) if self.ext == '.txt' else read_cameras_binary(cameras_path)
+        logging.info('load model %s from cache %s', self.path, self.cache_dir)
+        return ColmapModel(cameras, arrays['images'], arrays['points3D'])
+
+    def save(self, model):
+        manifest = {'version': self.VERSION, 'ext': self.ext, 'files': {}}
+        arrays_dir = None
+        try:
+            for name, filepath in self._source_files().items():
+                file_stat = os.stat(filepath)
+                manifest['files'][name] = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns,
+                                           'sha1': _file_sha1(filepath)}
+            os.makedirs(self.cache_dir, exist_ok=True)
+            arrays_dir = tempfile.mkdtemp(prefix=self.ARRAYS_PREFIX, dir=self.cache_dir)
+            for kind, arrays in (('images', model.images_arrays), ('points3D', model.points3D_arrays)):
+                for field, value in arrays._asdict().items():
+                    np.save(os.path.join(arrays_dir, kind + '_' + field + '.npy'), np.asarray(value))
+            manifest['arrays_dir'] = os.path.basename(arrays_dir)
+            self._write_manifest(manifest)
+        except OSError as e:
+            logging.warning('can not save model cache %s: %s', self.cache_dir, e)
+            if arrays_dir is not None:
+                shutil.rmtree(arrays_dir, ignore_errors=True)
+            return
+        # arrays of previous saves, mmapped arrays of running readers stay valid once unlinked
+        for entry in os.listdir(self.cache_dir):
+            if entry.startswith(self.ARRAYS_PREFIX) and entry != manifest['arrays_dir']:
+                shutil.rmtree(os.path.join(self.cache_dir, entry), ignore_errors=True)
+
+
+def model_digest(path, ext):
+    """sha1 over the content of the cameras/images/points3D files of a model."""
+    sha1 = hashlib.sha1()
+    for name in ModelCache.MODEL_FILES:
+        sha1.update(_file_sha1(os.path.join(path, name + ext)).encode())
+    return sha1.hexdigest()
+
+
+def _load_record_index(index_path, source_stat):
+    if not os.path.isfile(index_path):
+        return None
+    with np.load(index_path) as index:
+        if int(index['size']) != source_stat.st_size or int(index['mtime_ns']) != source_stat.st_mtime_ns:
+            return None
+        return index['ids'], index['offsets']
+
+
+def _save_record_index(index_path, source_stat, ids, offsets):
+    tmp_path = '%s.tmp%d' % (index_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, ids=ids, offsets=offsets,
+                     size=source_stat.st_size, mtime_ns=source_stat.st_mtime_ns)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logging.warning('can not save record index %s: %s', index_path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class _LazyMapping(Mapping):
+    def __init__(self, ids_fun, getter):
+        self._ids_fun = ids_fun
+        self._getter = getter
+
+    def __getitem__(self, key):
+        return self._getter(key)
+
+    def __iter__(self):
+        return iter(self._ids_fun().tolist())
+
+    def __len__(self):
+        return len(self._ids_fun())
+
+
+class LazyColmapModel:
+    """On demand access to images.bin / points3D.bin of a large sparse model.
+
+    The binary files are mmapped and a small offset index (id -> byte offset of
+    the record) is built on first use and persisted as <file>.idx.npz in
+    cache_dir (default <path>/.model_cache, next to the ModelCache arrays),
+    keyed by file size and mtime. Records are decoded only when asked for, so
+    a pose lookup costs one index load and one record decode.
+    """
+
+    INDEX_SUFFIX = '.idx.npz'
+
+    def __init__(self, path, persist_index=True, cache_dir=None):
+        self.path = path
+        self.persist_index = persist_index
+        self.cache_dir = cache_dir or os.path.join(path, '.model_cache')
+        self.cameras = read_cameras_binary(os.path.join(path, 'cameras.bin'))
+        self._files = {}
+        self._image_index = None
+        self._point3D_index = None
+        self.images = _LazyMapping(lambda: self.image_ids, self.image)
+        self.points3D = _LazyMapping(lambda: self.point3D_ids, self.point3D)
+
+    def _map(self, name):
+        if name not in self._files:
+            filepath = os.path.join(self.path, name)
+            with open(filepath, 'rb') as f:
+                self._files[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._files[name]
+
+    def _index(self, name, build_fun):
+        filepath = os.path.join(self.path, name)
+        source_stat = os.stat(filepath)
+        index_path = os.path.join(self.cache_dir, name + self.INDEX_SUFFIX)
+        index = _load_record_index(index_path, source_stat) if self.persist_index else None
+        if index is None:
+            ids, offsets = build_fun(self._map(name))
+            order = np.argsort(ids, kind='stable')
+            index = (ids[order], offsets[order])
+            if self.persist_index:
+                _save_record_index(index_path, source_stat, *index)
+        return index
+
+    @staticmethod
+    def _build_image_index(data):
+        num_reg_images = struct.unpack_from('<Q', data, 0)[0]
+        ids = np.empty(num_reg_images, dtype=np.int64)
+        offsets = np.empty(num_reg_images, dtype=np.int64)
+        offset = 8
+        for i in range(num_reg_images):
+            ids[i] = struct.unpack_from('<i', data, offset)[0]
+            offsets[i] = offset
+            name_end = data.find(b'\x00', offset + IMAGE_HEADER_DTYPE.itemsize)
+            num_points2D = struct.unpack_from('<Q', data, name_end + 1)[0]
+            offset = name_end + 9 + POINT2D_DTYPE.itemsize * num_points2D
+        return ids, offsets
+
+    @staticmethod
+    def _build_point3D_index(data):
+        num_points = struct.unpack_from('<Q', data, 0)[0]
+        offsets = _points3d_record_offsets(data, num_points)[:-1]
+        # the point3D_id opens every record
+        id_bytes = np.frombuffer(data, dtype=np.uint8)[offsets[:, None] + np.arange(8)]
+        return id_bytes.view('<u8').ravel().astype(np.int64), offsets
+
+    @staticmethod
+    def _find(index, key):
+        ids, offsets = index
+        pos = np.searchsorted(ids, key)
+        if pos >= len(ids) or ids[pos] != key:
+            raise KeyError(key)
+        return int(offsets[pos])
+
+    def _image_offset(self, image_id):
+        if self._image_index is None:
+            self._image_index = self._index('images.bin', self._build_image_index)
+        return self._find(self._image_index, image_id)
+
+    def _point3D_offset(self, point3D_id):
+        if self._point3D_index is None:
+            self._point3D_index = self._index('points3D.bin', self._build_point3D_index)
+        return self._find(self._point3D_index, point3D_id)
+
+    @property
+    def image_ids(self):
+        if self._image_index is None:
+            self._image_index = self._index('images.bin', self._build_image_index)
+        return self._image_index[0]
+
+    @property
+    def point3D_ids(self):
+        if self._point3D_index is None:
+            self._point3D_index = self._index('points3D.bin', self._build_point3D_index)
+        return self._point3D_index[0]
+
+    def pose(self, image_id):
+        """(qvec, tvec, camera_id) of image_id, without decoding its keypoints."""
+        offset = self._image_offset(image_id)
+        header = np.frombuffer(self._map('images.bin'), dtype=IMAGE_HEADER_DTYPE, count=1, offset=offset)[0]
+        return header['qvec'].copy(), header['tvec'].copy(), int(header['camera_id'])
+
+    def image(self, image_id):
+        offset = self._image_offset(image_id)
+        data = self._map('images.bin')
+        header = np.frombuffer(data, dtype=IMAGE_HEADER_DTYPE, count=1, offset=offset)[0]
+        name_end = data.find(b'\x00', offset + IMAGE_HEADER_DTYPE.itemsize)
+        num_points2D = struct.unpack_from('<Q', data, name_end + 1)[0]
+        points2D = np.frombuffer(data, dtype=POINT2D_DTYPE, count=num_points2D, offset=name_end + 9)
+        return Image(id=int(header['id']), qvec=header['qvec'].copy(), tvec=header['tvec'].copy(),
+                     camera_id=int(header['camera_id']),
+                     name=data[offset + IMAGE_HEADER_DTYPE.itemsize:name_end].decode('utf-8'),
+                     xys=points2D['xy'].copy(), point3D_ids=points2D['point3D_id'].copy())
+
+    def point3D(self, point3D_id):
+        offset = self._point3D_offset(point3D_id)
+        data = self._map('points3D.bin')
+        header = np.frombuffer(data, dtype=POINT3D_HEADER_DTYPE, count=1, offset=offset)[0]
+        track = np.frombuffer(data, dtype=TRACK_ELEM_DTYPE, count=int(header['track_length']),
+                              offset=offset + POINT3D_HEADER_DTYPE.itemsize)
+        return Point3D(id=int(header['id']), xyz=header['xyz'].copy(), rgb=header['rgb'].astype(np.int64),
+                       error=header['error'], image_ids=track['image_id'].copy(),
+                       point2D_idxs=track['point2D_idx'].copy())
+
+    def close(self):
+        for data in self._files.values():
+            data.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -18,6 +18,15 @@ class GlobalOptionsStorage:
         parser.add_argument('--submodel_name', type=str, default='ESMNetV3', help='model_name for ESMNet')
         parser.add_argument('--mvs_ckpt_path', type=str, default=None, help='checkpoint for neural network')
         parser.add_argument('--mvs_ckpt_dir', type=str, default=None, help='checkpoint for neural network')
+        parser.add_argument('--model_cache', action='store_true',
+                            help='cache decoded sparse models next to the model files to speed up later loads')
+        parser.add_argument('--image_placement', type=str, default='move', choices=['move', 'hardlink', 'reflink', 'copy'],
+                            help='how converted images are placed in the output scene, hardlink/reflink keep the source')
+        parser.add_argument('--png_compression', type=int, default=1, choices=range(10),
+                            help='png compression level of converted images, 1 is fast, 9 small')
+        parser.add_argument('--conversion_link', type=str, default='hardlink', choices=['hardlink', 'symlink', 'none'],
+                            help='keep sfm to mvsnet conversions once in <workspace>/store (read-only) and link them '
+                                 'in every target directory, none converts in the target directory')
         self.parser = parser
         self.options = None
 
@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+
+
+class CovisibilityIndex:
+    """Sparse covisibility graph of a ColmapModel.
+
+    Only image pairs sharing at least one point are kept. Pairs are (a, b)
+    image rows with a < b, sorted; the points they share are stored CSR style,
+    shared_point_rows[pair_offsets[p]:pair_offsets[p + 1]] in point row order,
+    once per track element pair (a point seen twice by one image is shared
+    twice, like the per track loops this replaces).
+    """
+
+    def __init__(self, model, pair_image_rows, pair_offsets, shared_point_rows):
+        self.model = model
+        self.pair_image_rows = pair_image_rows
+        self.pair_offsets = pair_offsets
+        self.shared_point_rows = shared_point_rows
+        self._pair_keys = pair_image_rows[:, 0] * model.num_images + pair_image_rows[:, 1]
+
+        # image -> (neighbor image row, pair) adjacency, CSR by image row
+        num_images = model.num_images
+        sources = np.concatenate([pair_image_rows[:, 0], pair_image_rows[:, 1]])
+        order = np.argsort(sources, kind='stable')
+        self._neighbor_rows = np.concatenate([pair_image_rows[:, 1], pair_image_rows[:, 0]])[order]
+        self._neighbor_pairs = np.concatenate([np.arange(self.num_pairs)] * 2)[order]
+        self._neighbor_offsets = np.zeros(num_images + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_images), out=self._neighbor_offsets[1:])
+
+    @classmethod
+    def from_model(cls, model):
+        """Build the index in one pass over the track CSR, one batch per distinct track length."""
+        num_images = model.num_images
+        track_lengths = model.track_lengths
+        track_offsets = model.points3D_arrays.track_offsets
+        track_image_rows = model.track_image_rows()
+
+        keys, point_rows = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        for track_length in np.unique(track_lengths[track_lengths >= 2]).tolist():
+            points = np.flatnonzero(track_lengths == track_length)
+            tracks = track_image_rows[track_offsets[points][:, None] + np.arange(track_length)]
+            first, second = np.triu_indices(track_length, 1)
+            a, b = tracks[:, first].ravel(), tracks[:, second].ravel()
+            valid = a != b
+            keys.append((np.minimum(a, b) * num_images + np.maximum(a, b))[valid])
+            point_rows.append(np.repeat(points, len(first))[valid])
+        keys = np.concatenate(keys)
+        point_rows = np.concatenate(point_rows)
+
+        order = np.lexsort((point_rows, keys))
+        keys = keys[order]
+        unique_keys, starts = np.unique(keys, return_index=True)
+        pair_offsets = np.append(starts, len(keys)).astype(np.int64)
+        pair_image_rows = np.stack([unique_keys // num_images, unique_keys % num_images], axis=-1) \
+            if num_images > 0 else np.empty((0, 2), dtype=np.int64)
+        return cls(model, pair_image_rows, pair_offsets, point_rows[order])
+
+    @property
+    def num_pairs(self):
+        return len(self.pair_image_rows)
+
+    @property
+    def num_shared(self):
+        """Number of shared points of every pair."""
+        return np.diff(self.pair_offsets)
+
+    def pair_entry_pairs(self):
+        """Pair of every element of shared_point_rows."""
+        return np.repeat(np.arange(self.num_pairs), self.num_shared)
+
+    def find_pair(self, image_row_a, image_row_b):
+        """Pair of two image rows (in any order), -1 if they share no point."""
+        a, b = min(image_row_a, image_row_b), max(image_row_a, image_row_b)
+        key = a * self.model.num_images + b
+        pos = np.searchsorted(self._pair_keys, key)
+        if pos < len(self._pair_keys) and self._pair_keys[pos] == key:
+            return int(pos)
+        return -1
+
+    def neighbors(self, image_row):
+        """(neighbor image rows, pairs) of image_row."""
+        begin, end = self._neighbor_offsets[image_row], self._neighbor_offsets[image_row + 1]
+        return self._neighbor_rows[begin:end], self._neighbor_pairs[begin:end]
+
+    def shared_point_rows_of(self, pair):
+        return self.shared_point_rows[self.pair_offsets[pair]:self.pair_offsets[pair + 1]]
+
+    def shared_point3D_ids(self, image_id_a, image_id_b):
+        """Ids of the points seen by both images, empty if none."""
+        pair = self.find_pair(self.model.image_rows[image_id_a], self.model.image_rows[image_id_b])
+        if pair < 0:
+            return np.empty(0, dtype=self.model.points3D_arrays.ids.dtype)
+        return self.model.points3D_arrays.ids[self.shared_point_rows_of(pair)]
+
+    def triangulation_angles(self, centers=None, begin=0, end=None, fold=True):
+        """Angle (radians) between the two viewing rays of every shared point of
+        pairs [begin, end), from the pose table camera centers by default.
+        Folded to [0, pi / 2] like COLMAP's CalculateTriangulationAngle unless
+        fold is False."""
+        if centers is None:
+            centers = self.model.poses.centers
+        end = self.num_pairs if end is None else end
+        entry_pairs = np.repeat(np.arange(begin, end), self.num_shared[begin:end])
+        xyzs = self.model.points3D_arrays.xyzs[self.shared_point_rows[self.pair_offsets[begin]:self.pair_offsets[end]]]
+        center_a = centers[self.pair_image_rows[entry_pairs, 0]]
+        center_b = centers[self.pair_image_rows[entry_pairs, 1]]
+        d1 = np.sum(np.square(xyzs - center_a), axis=-1)
+        d2 = np.sum(np.square(xyzs - center_b), axis=-1)
+        d3 = np.sum(np.square(center_a - center_b), axis=-1)
+        angles = np.abs(np.arccos(np.clip((d1 + d2 - d3) / (2. * np.sqrt(d1 * d2)), -1., 1.)))
+        return np.minimum(angles, np.pi - angles) if fold else angles
@@ -0,0 +1,213 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import struct
+import logging
+import pathlib
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from pipeline.utils import LogThanExitIfFailed
+
+IMAGE_EXTENSIONS = ['.JPG', '.jpg', '.JPEG', '.jpeg', '.PNG', '.png']
+
+# width, height as stored in the file, orientation is the EXIF orientation tag (1 if absent),
+# focal_length the EXIF focal length in mm (None if absent)
+ImageInfo = collections.namedtuple('ImageInfo', ['path', 'format', 'width', 'height', 'orientation', 'focal_length'])
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+JPEG_SOS_MARKER = 0xDA
+
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_IFD_TAG = 0x8769
+EXIF_FOCAL_LENGTH_TAG = 0x920A
+# size in bytes of the TIFF field types
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+# (real path, size, mtime) -> ImageInfo
+_image_info_cache = {}
+_image_info_cache_lock = threading.Lock()
+
+
+def oriented_size(info):
+    """(width, height) once the EXIF orientation is applied, like cv2.imread does."""
+    if info.orientation in (5, 6, 7, 8):
+        return info.height, info.width
+    return info.width, info.height
+
+
+def _parse_tiff_ifd(data, offset, endian):
+    """{tag: (type, count, value or offset field bytes)} of the IFD at offset."""
+    num_entries, = struct.unpack_from(endian + 'H', data, offset)
+    entries = {}
+    for i in range(num_entries):
+        tag, field_type, count = struct.unpack_from(endian + 'HHI', data, offset + 2 + 12 * i)
+        entries[tag] = (field_type, count, data[offset + 10 + 12 * i:offset + 14 + 12 * i])
+    return entries
+
+
+def parse_exif(data):
+    """(orientation, focal length in mm) of a TIFF structured EXIF block, None for missing tags."""
+    endian = {b'II': '<', b'MM': '>'}.get(data[:2])
+    if endian is None:
+        return None, None
+    ifd0_offset, = struct.unpack_from(endian + 'I', data, 4)
+    ifd0 = _parse_tiff_ifd(data, ifd0_offset, endian)
+
+    orientation = None
+    if EXIF_ORIENTATION_TAG in ifd0:
+        orientation, = struct.unpack_from(endian + 'H', ifd0[EXIF_ORIENTATION_TAG][2])
+
+    focal_length = None
+    if EXIF_IFD_TAG in ifd0:
+        exif_ifd_offset, = struct.unpack_from(endian + 'I', ifd0[EXIF_IFD_TAG][2])
+        exif_ifd = _parse_tiff_ifd(data, exif_ifd_offset, endian)
+        if EXIF_FOCAL_LENGTH_TAG in exif_ifd:
+            field_type, _, value = exif_ifd[EXIF_FOCAL_LENGTH_TAG]
+            if field_type in (5, 10):
+                rational_offset, = struct.unpack_from(endian + 'I', value)
+                numerator, denominator = struct.unpack_from(endian + ('II' if field_type == 5 else 'ii'),
+                                                            data, rational_offset)
+                focal_length = numerator / denominator if denominator != 0 else None
+    return orientation, focal_length
+
+
+def _read_jpeg_header(f, with_exif):
+    """(width, height, exif block or None), reading markers up to the first SOF."""
+    exif = None
+    while True:
+        byte = f.read(1)
+        if byte != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':  # fill bytes
+            marker = f.read(1)
+        if len(marker) != 1:
+            return None
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == JPEG_SOS_MARKER:
+            return None
+        length_bytes = f.read(2)
+        if len(length_bytes) != 2:
+            return None
+        length, = struct.unpack('>H', length_bytes)
+        if marker in JPEG_SOF_MARKERS:
+            segment = f.read(5)
+            if len(segment) != 5:
+                return None
+            _, height, width = struct.unpack('>BHH', segment)
+            return width, height, exif
+        if with_exif and marker == 0xE1 and exif is None:
+            segment = f.read(length - 2)
+            if segment.startswith(b'Exif\x00\x00'):
+                exif = segment[6:]
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def _read_png_header(f, with_exif):
+    """(width, height, exif block or None) from IHDR, and the eXIf chunk if it comes before IDAT."""
+    length, chunk_type = struct.unpack('>I4s', f.read(8))
+    if chunk_type != b'IHDR':
+        return None
+    width, height = struct.unpack('>II', f.read(8))
+    f.seek(length - 8 + 4, os.SEEK_CUR)
+    exif = None
+    while with_exif:
+        chunk_header = f.read(8)
+        if len(chunk_header) != 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', chunk_header)
+        if chunk_type in (b'IDAT', b'IEND'):
+            break
+        if chunk_type == b'eXIf':
+            exif = f.read(length)
+            break
+        f.seek(length + 4, os.SEEK_CUR)
+    return width, height, exif
+
+
+def _read_image_info(path, with_exif):
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+        header = None
+        if magic[:2] == b'\xff\xd8':
+            image_format = 'jpeg'
+            f.seek(2)
+            header = _read_jpeg_header(f, with_exif)
+        elif magic == PNG_SIGNATURE:
+            image_format = 'png'
+            header = _read_png_header(f, with_exif)
+    orientation, focal_length = None, None
+    if header is not None:
+        width, height, exif = header
+        if exif is not None:
+            try:
+                orientation, focal_length = parse_exif(exif)
+            except struct.error:
+                logging.warning('corrupted exif in %s, ignored', path)
+    else:
+        # unknown format or unexpected header layout, fall back to decoding the image
+        logging.warning('can not parse the header of %s, decode it', path)
+        image = cv2.imread(str(path), cv2.IMREAD_UNCHANGED | cv2.IMREAD_IGNORE_ORIENTATION)
+        LogThanExitIfFailed(image is not None, 'can not read image %s', path)
+        image_format = 'unknown'
+        height, width = image.shape[:2]
+    return ImageInfo(path=str(path), format=image_format, width=width, height=height,
+                     orientation=orientation or 1, focal_length=focal_length)
+
+
+def read_image_info(path, with_exif=True):
+    """ImageInfo of one image, from its JPEG (SOF) or PNG (IHDR) header only.
+
+    Results are cached per file, keyed by the real path, size and mtime so a
+    rewritten file is probed again.
+    """
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns, with_exif)
+    with _image_info_cache_lock:
+        info = _image_info_cache.get(key)
+    if info is None:
+        info = _read_image_info(path, with_exif)
+        with _image_info_cache_lock:
+            _image_info_cache[key] = info
+    return info
+
+
+def read_images_info(paths, num_threads=None, with_exif=True):
+    """ImageInfo of every path, probed in a thread pool (the reads are IO bound)."""
+    paths = list(paths)
+    num_threads = num_threads or min(32, (os.cpu_count() or 1) + 4)
+    if num_threads <= 1 or len(paths) <= 1:
+        return [read_image_info(path, with_exif) for path in paths]
+    with ThreadPoolExecutor(min(num_threads, len(paths))) as executor:
+        return list(executor.map(lambda path: read_image_info(path, with_exif), paths))
+
+
+def list_images(images_dir, extensions=IMAGE_EXTENSIONS):
+    """Sorted image files of images_dir."""
+    return sorted(f for f in pathlib.Path(images_dir).iterdir() if f.suffix in extensions and f.is_file())
+
+
+def images_glob_pattern(images_dir, num_threads=None):
+    """Glob pattern ('*' + suffix) matching the images of images_dir, for the
+    tools taking an image wildcard. All the images are probed so a directory
+    mixing suffixes, or holding unreadable images, is reported up front."""
+    images = list_images(images_dir)
+    LogThanExitIfFailed(len(images) > 0, 'no image found in %s', images_dir)
+    infos = read_images_info(images, num_threads, with_exif=False)
+    suffixes = collections.Counter(image.suffix for image in images)
+    suffix = suffixes.most_common(1)[0][0]
+    if len(suffixes) > 1:
+        logging.warning('images of %s have several suffixes %s, only *%s are used', images_dir, dict(suffixes), suffix)
+    logging.info('%d images in %s, %d x %d to %d x %d', len(images), images_dir,
+                 min(info.width for info in infos), min(info.height for info in infos),
+                 max(info.width for info in infos), max(info.height for info in infos))
+    return '*' + suffix
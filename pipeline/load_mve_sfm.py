@@ -2,97 +2,196 @@
 
 import os
 import numpy as np
+import mmap
 import struct
-import cv2
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
-from pipeline.utils import LogThanExitIfFailed, InitLogging
-from third_party.colmap.read_write_model import Camera, Image, Point3D, rotmat2qvec, read_model
+from pipeline.utils import LogThanExitIfFailed, InitLogging, PlaceFile
+from third_party.colmap.read_write_model import Camera, ImagesArrays, Points3DArrays, CAMERA_MODEL_NAMES, \
+    rotmats2qvecs
+from pipeline.colmap_model import ColmapModel
+from pipeline.image_info import read_images_info, oriented_size
+from pipeline.view_selection import image_indices
+from pipeline.common_options import GLOBAL_OPTIONS as FLAGS
+
+
+BUNDLER_SIGNATURES = {'PHOTOSYNTHER': 'drews 1.0', 'BUNDLER': '# Bundle file v0.3'}
+
+# Columnar content of a Bundler file: per camera (focal length, k1, k2), rotation
+# and translation; per point position, color and track (CSR, (camera, feature) pairs)
+BundlerArrays = collections.namedtuple(
+    'BundlerArrays', ['intrinsics', 'rotations', 'translations', 'xyzs', 'rgbs',
+                      'track_offsets', 'track_image_ids', 'track_point2D_idxs'])
+
+
+def read_bundler_arrays(filepath, format='PHOTOSYNTHER'):
+    """Parse a Bundler file into BundlerArrays.
+
+    The file is read at once and every fixed structure block (camera lines,
+    point positions, colors, tracks) is parsed with a single split; track
+    lines are joined with a -1 sentinel so their boundaries are found without
+    a per point loop.
+    """
+    LogThanExitIfFailed(format in BUNDLER_SIGNATURES, 'wrong format type')
+    with open(filepath, 'r') as f:
+        lines = f.read().splitlines()
+    LogThanExitIfFailed(lines[0].strip() == BUNDLER_SIGNATURES[format], 'wrong format type: expect "%s", got %s',
+                        BUNDLER_SIGNATURES[format], lines[0].strip())
+    num_images, num_points = map(int, lines[1].split())
+    cameras_end = 2 + 5 * num_images
+    points_end = cameras_end + 3 * num_points
+    assert all(line.strip() == '' for line in lines[points_end:])
+
+    cameras = np.array(' '.join(lines[2:cameras_end]).split(), dtype=np.float64).reshape(num_images, 5, 3)
+    xyzs = np.array(' '.join(lines[cameras_end:points_end:3]).split(), dtype=np.float64).reshape(num_points, 3)
+    rgbs = np.array(' '.join(lines[cameras_end + 1:points_end:3]).split(), dtype=np.int64).reshape(num_points, 3)
+
+    tracks = np.array(' -1 '.join(lines[cameras_end + 2:points_end:3]).split(), dtype=np.int64)
+    line_starts = np.concatenate([[0], np.flatnonzero(tracks == -1) + 1]).astype(np.int64)[:num_points]
+    track_lengths = tracks[line_starts]
+    assert len(line_starts) == num_points
+    assert np.array_equal(np.diff(np.append(line_starts, len(tracks) + 1)), 3 * track_lengths + 2)
+    elements = np.ones(len(tracks), dtype=bool)
+    elements[line_starts] = False
+    elements[line_starts[1:] - 1] = False
+    elements = tracks[elements].reshape(-1, 3)
+
+    track_offsets = np.zeros(num_points + 1, dtype=np.int64)
+    np.cumsum(track_lengths, out=track_offsets[1:])
+    return BundlerArrays(intrinsics=cameras[:, 0], rotations=cameras[:, 1:4], translations=cameras[:, 4],
+                         xyzs=xyzs, rgbs=rgbs.astype(np.uint8), track_offsets=track_offsets,
+                         track_image_ids=elements[:, 0].astype(np.int32),
+                         track_point2D_idxs=elements[:, 1].astype(np.int32))
+
+
+def _format_rows(fmt, values):
+    """fmt applied to every row of values, in a single % formatting."""
+    values = np.asarray(values)
+    return (fmt * len(values)) % tuple(values.ravel().tolist())
+
+
+def write_bundler_arrays(bundler, filepath, format='PHOTOSYNTHER', chunk_size=1 << 18):
+    """Write BundlerArrays as a Bundler file, the numbers printed with %f / %d
+    like the per value writer it replaces; points are formatted chunk_size at
+    a time."""
+    num_images, num_points = len(bundler.intrinsics), len(bundler.xyzs)
+    with open(filepath, 'w') as f:
+        f.write(BUNDLER_SIGNATURES[format] + '\n')
+        f.write('%d %d\n' % (num_images, num_points))
+        cameras = np.concatenate([bundler.intrinsics[:, None], bundler.rotations, bundler.translations[:, None]],
+                                 axis=1)
+        f.write(_format_rows('%f %f %f\n', cameras.reshape(-1, 3)))
+
+        for begin in range(0, num_points, chunk_size):
+            end = min(begin + chunk_size, num_points)
+            track_begin, track_end = bundler.track_offsets[begin], bundler.track_offsets[end]
+            offsets = (bundler.track_offsets[begin:end + 1] - track_begin).tolist()
+            xyzs = _format_rows('%f %f %f\n', bundler.xyzs[begin:end]).splitlines(keepends=True)
+            rgbs = _format_rows('%d %d %d\n', bundler.rgbs[begin:end]).splitlines(keepends=True)
+            track = _format_rows(' %d %d 0\n', np.stack([bundler.track_image_ids[track_begin:track_end],
+                                                          bundler.track_point2D_idxs[track_begin:track_end]],
+                                                         axis=-1)).splitlines()
+            f.write(''.join([xyzs[i] + rgbs[i] + str(offsets[i + 1] - offsets[i]) +
+                             ''.join(track[offsets[i]:offsets[i + 1]]) + '\n' for i in range(end - begin)]))
 
 
 def read_bundler(filepath, images_xys, format='PHOTOSYNTHER'):
-    cameras = {}
-    images = {}
-    points3D = {}
+    """ColmapModel of an MVE Bundler file. images_xys are the normalized feature
+    positions of every view (see read_mve_feature); the view sizes come from the
+    original.jpg headers next to the file."""
+    bundler = read_bundler_arrays(filepath, format)
+    num_images = len(bundler.intrinsics)
+    assert len(images_xys) == num_images
     image_dir = os.path.dirname(filepath)
-    with open(filepath, 'r') as f:
-        line = f.readline().strip()
-        if format == 'PHOTOSYNTHER':
-            LogThanExitIfFailed(line == 'drews 1.0', 'wrong format type: expect "drews 1.0", got %s', line)
-        elif format == 'BUNDLER':
-            LogThanExitIfFailed(line == '# Bundle file v0.3', 'wrong format type: expect "# Bundle file v0.3", got %s',
-                                line)
-        else:
-            LogThanExitIfFailed(False, 'wrong format type')
-
-        num_images, num_points = map(int, f.readline().split())
-
-        for i in range(num_images):
-            height, width, _ = cv2.imread(os.path.join(image_dir, 'views', 'view_%04d.mve' % i, 'original.jpg')).shape
-            max_dim = max(height, width)
-            params = np.array(tuple(map(float, f.readline().split())))
-            cameras[i] = Camera(id=i, model='RADIAL',
-                                width=width,
-                                height=height,
-                                params=np.array(
-                                    (params[0] * max_dim, width / 2. - 0.5, height / 2 - 0.5, params[1], params[2])))
-            row1 = np.array(tuple(map(float, f.readline().split())))
-            row2 = np.array(tuple(map(float, f.readline().split())))
-            row3 = np.array(tuple(map(float, f.readline().split())))
-            qvec = rotmat2qvec(np.stack([row1, row2, row3]))
-            tvec = np.array(tuple(map(float, f.readline().split())))
-            images[i] = Image(
-                id=i, qvec=qvec, tvec=tvec,
-                camera_id=i, name="%04d.jpg" % i,
-                xys=images_xys[i] * max_dim + np.array([width / 2., height / 2.]) - 0.5,
-                point3D_ids=np.ones(len(images_xys[i]), dtype=np.int) * -1)
-
-        for i in range(num_points):
-            xyz = np.array(tuple(map(float, f.readline().split())))
-            rgb = np.array(tuple(map(int, f.readline().split())))
-            elems = f.readline().split()
-            image_ids = np.array(tuple(map(int, elems[1::3])))
-            point2D_idxs = np.array(tuple(map(int, elems[2::3])))
-            track_lengths = int(elems[0])
-            assert track_lengths == len(image_ids)
-            assert track_lengths == len(point2D_idxs)
-            points3D[i] = Point3D(id=i, xyz=xyz, rgb=rgb,
-                                  error=0., image_ids=image_ids,
-                                  point2D_idxs=point2D_idxs)
-            for image_id, point2D_id in zip(image_ids, point2D_idxs):
-                images[image_id].point3D_ids[point2D_id] = i
-        left = f.read()
-        assert (left is None) or (left == '')
-    assert len(images_xys) == len(images)
-    return cameras, images, points3D
-
-
-def read_mve_feature(filepath):
-    PREBUNDLE_SIGNATURE = b"MVE_PREBUNDLE\n"
-    integer_struct = struct.Struct('i')
+    image_sizes = np.array([oriented_size(info) for info in read_images_info(
+        [os.path.join(image_dir, 'views', 'view_%04d.mve' % i, 'original.jpg') for i in range(num_images)])],
+        dtype=np.int64).reshape(-1, 2)
+    widths, heights = image_sizes[:, 0], image_sizes[:, 1]
+    max_dims = np.maximum(widths, heights)
+
+    cameras = {}
+    for i in range(num_images):
+        focal_length, k1, k2 = bundler.intrinsics[i]
+        cameras[i] = Camera(id=i, model='RADIAL', width=int(widths[i]), height=int(heights[i]),
+                            params=np.array((focal_length * max_dims[i], widths[i] / 2. - 0.5, heights[i] / 2 - 0.5,
+                                             k1, k2)))
+
+    point2D_offsets = np.zeros(num_images + 1, dtype=np.int64)
+    np.cumsum([len(xys) for xys in images_xys], out=point2D_offsets[1:])
+    num_points2D = np.diff(point2D_offsets)
+    xys = np.concatenate([np.reshape(xys, (-1, 2)) for xys in images_xys] + [np.empty((0, 2))])
+    xys = xys * np.repeat(max_dims, num_points2D)[:, None] \
+        + np.repeat(np.stack([widths / 2., heights / 2.], axis=-1), num_points2D, axis=0) - 0.5
+    point3D_ids = np.full(point2D_offsets[-1], -1, dtype=np.int64)
+    num_points = len(bundler.xyzs)
+    point3D_ids[point2D_offsets[bundler.track_image_ids] + bundler.track_point2D_idxs] = \
+        np.repeat(np.arange(num_points), np.diff(bundler.track_offsets))
+
+    images_arrays = ImagesArrays(ids=np.arange(num_images, dtype=np.int64),
+                                 qvecs=rotmats2qvecs(bundler.rotations) if num_images > 0 else np.empty((0, 4)),
+                                 tvecs=bundler.translations, camera_ids=np.arange(num_images, dtype=np.int64),
+                                 names=['%04d.jpg' % i for i in range(num_images)],
+                                 point2D_offsets=point2D_offsets, xys=xys, point3D_ids=point3D_ids)
+    points3D_arrays = Points3DArrays(ids=np.arange(num_points, dtype=np.int64), xyzs=bundler.xyzs,
+                                     rgbs=bundler.rgbs, errors=np.zeros(num_points),
+                                     track_offsets=bundler.track_offsets, track_image_ids=bundler.track_image_ids,
+                                     track_point2D_idxs=bundler.track_point2D_idxs)
+    return ColmapModel(cameras, images_arrays, points3D_arrays)
+
+
+PREBUNDLE_SIGNATURE = b"MVE_PREBUNDLE\n"
+MVE_POSITION_DTYPE = np.dtype('<f4')
+MVE_COLOR_DTYPE = np.dtype('u1')
+MVE_MATCH_HEADER = struct.Struct('<iii')
+MVE_CORRESPONDENCE_DTYPE = np.dtype('<i4')
+
+
+def read_mve_feature(filepath, with_colors=False, with_matches=False):
+    """Feature positions of every view of an MVE prebundle.sfm, a list of (N, 2) float arrays.
+
+    The file is mmapped and positions are decoded with np.frombuffer; colors
+    and matches are skipped by offset unless asked for. With with_colors or
+    with_matches the result is (images_xys, images_colors, matches), colors a
+    list of (N, 3) uint8 arrays and matches a list of (view1_id, view2_id,
+    (M, 2) int32 feature index array), None for the parts not asked for.
+    """
+    int_size = struct.calcsize('<i')
     images_xys = []
-    with open(filepath, 'rb') as f:
-        assert f.read(len(PREBUNDLE_SIGNATURE)) == PREBUNDLE_SIGNATURE
-        num_views = integer_struct.unpack(f.read(integer_struct.size))[0]
+    images_colors = [] if with_colors else None
+    matches = [] if with_matches else None
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        assert data[:len(PREBUNDLE_SIGNATURE)] == PREBUNDLE_SIGNATURE
+        offset = len(PREBUNDLE_SIGNATURE)
+        num_views, = struct.unpack_from('<i', data, offset)
+        offset += int_size
 
-        vec_struct = struct.Struct('ff')
-        colol_struct = struct.Struct('BBB')
         for i in range(num_views):
-            num_positions = integer_struct.unpack(f.read(integer_struct.size))[0]
-            xys = np.array(list(vec_struct.iter_unpack(f.read(vec_struct.size * num_positions))), dtype=np.float)
-            images_xys.append(xys)
-            num_colors = integer_struct.unpack(f.read(integer_struct.size))[0]
-            for color in colol_struct.iter_unpack(f.read(colol_struct.size * num_colors)):
-                pass
-
-        num_pairs = integer_struct.unpack(f.read(integer_struct.size))[0]
-        match_struct = struct.Struct('iii')
-        correspondence_struct = struct.Struct('ii')
+            num_positions, = struct.unpack_from('<i', data, offset)
+            offset += int_size
+            images_xys.append(np.frombuffer(data, dtype=MVE_POSITION_DTYPE, count=2 * num_positions,
+                                            offset=offset).reshape(-1, 2).astype(np.float64))
+            offset += 2 * MVE_POSITION_DTYPE.itemsize * num_positions
+            num_colors, = struct.unpack_from('<i', data, offset)
+            offset += int_size
+            if with_colors:
+                images_colors.append(np.frombuffer(data, dtype=MVE_COLOR_DTYPE, count=3 * num_colors,
+                                                   offset=offset).reshape(-1, 3).copy())
+            offset += 3 * MVE_COLOR_DTYPE.itemsize * num_colors
+
+        num_pairs, = struct.unpack_from('<i', data, offset)
+        offset += int_size
         for i in range(num_pairs):
-            _, _, num_matches = match_struct.unpack(f.read(match_struct.size))
-            for c in correspondence_struct.iter_unpack(f.read(correspondence_struct.size * num_matches)):
-                pass
-        left = f.read()
-        assert (left is None) or (left == b'')
+            view1_id, view2_id, num_matches = MVE_MATCH_HEADER.unpack_from(data, offset)
+            offset += MVE_MATCH_HEADER.size
+            if with_matches:
+                matches.append((view1_id, view2_id,
+                                np.frombuffer(data, dtype=MVE_CORRESPONDENCE_DTYPE, count=2 * num_matches,
+                                              offset=offset).reshape(-1, 2).copy()))
+            offset += 2 * MVE_CORRESPONDENCE_DTYPE.itemsize * num_matches
+        assert offset == len(data)
+    if with_colors or with_matches:
+        return images_xys, images_colors, matches
     return images_xys
 
 
@@ -101,8 +200,7 @@ def load_mve_sfm(sfm_mve_dir):
     return read_bundler(os.path.join(sfm_mve_dir, 'view/synth_0.out'), images_xys)
 
 
-def save_mve_sfm(sfm_colmap_dir, image_dir, sfm_mve_dir):
-    mve_meta_template = '''# MVE view meta data is stored in INI-file syntax.
+MVE_META_TEMPLATE = '''# MVE view meta data is stored in INI-file syntax.
 # This file is generated, formatting will get lost.
 
 [camera]
@@ -115,63 +213,63 @@ translation =%s
 [view]
 id = %d
 name = %s'''
+
+
+def _write_mve_view(view_image_dir, image_path, meta, placement):
+    os.mkdir(view_image_dir)
+    PlaceFile(image_path, os.path.join(view_image_dir, 'undistorted.png'), placement)
+    with open(os.path.join(view_image_dir, 'meta.ini'), 'w') as f:
+        f.write(meta)
+
+
+def save_mve_sfm(sfm_colmap_dir, image_dir, sfm_mve_dir, placement=None, num_threads=None):
+    """Write the COLMAP model in sfm_colmap_dir (undistorted, PINHOLE cameras)
+    as an MVE scene in sfm_mve_dir/view. The view directories (meta.ini and
+    image, placed with PlaceFile, FLAGS.image_placement by default) are
+    written by a thread pool while synth_0.out is being written."""
+    placement = placement or FLAGS.image_placement
     mve_dir = os.path.join(sfm_mve_dir, 'view')
     os.mkdir(mve_dir)
     view_dir = os.path.join(mve_dir, 'views')
     os.mkdir(view_dir)
 
-    cameras, images, points3D = read_model(sfm_colmap_dir, '.bin')
-
-    with open(os.path.join(mve_dir, 'synth_0.out'), 'w') as f:
-        f.write('drews 1.0\n')
-        f.write('%d %d\n' % (len(images), len(points3D)))
-        new_image_id = {}
-        cnt = 0
-        new_images = sorted(list(images.items()), key= lambda x: x[0])
-        for image_id, image in new_images:
-            camera = cameras[image.camera_id]
-            max_dim = max(camera.width, camera.height)
-
-            f.write('%f %f %f\n' % (camera.params[0] / max_dim, 0., 0.))
-            R_matrix = image.qvec2rotmat()
-            f.write('%f %f %f\n' % (R_matrix[0, 0], R_matrix[0, 1], R_matrix[0, 2]))
-            f.write('%f %f %f\n' % (R_matrix[1, 0], R_matrix[1, 1], R_matrix[1, 2]))
-            f.write('%f %f %f\n' % (R_matrix[2, 0], R_matrix[2, 1], R_matrix[2, 2]))
-            f.write('%f %f %f\n' % (image.tvec[0], image.tvec[1], image.tvec[2]))
-            new_image_id[image_id] = cnt
-            cnt = cnt + 1
-
-        for _, point3D in points3D.items():
-            f.write('%f %f %f\n' % (point3D.xyz[0], point3D.xyz[1], point3D.xyz[2]))
-            f.write('%d %d %d\n' % (point3D.rgb[0], point3D.rgb[1], point3D.rgb[2]))
-            f.write('%d' % len(point3D.image_ids))
-            for image_id, point2D_id in zip(point3D.image_ids, point3D.point2D_idxs):
-                f.write(' %d %d 0' % (new_image_id[image_id], point2D_id))
-            f.write('\n')
-        for image_id, image in new_images:
-            camera = cameras[image.camera_id]
-            max_dim = max(camera.width, camera.height)
-            if image is None:
-                continue
-
-            view_image_dir = os.path.join(view_dir, 'view_%04d.mve' % new_image_id[image_id])
-            os.mkdir(view_image_dir)
-            os.rename(os.path.join(image_dir, image.name), os.path.join(view_image_dir, 'undistorted.png'))
-
-            R_str = ''
-            for v in np.nditer(image.qvec2rotmat()):
-                R_str = R_str + ' ' + str(v)
-            T_str = ''
-            for v in np.nditer(image.tvec):
-                T_str = T_str + ' ' + str(v)
-
-            assert camera.model == 'PINHOLE'
-            assert abs(camera.params[0] - camera.params[1]) < 1e-8
-            with open(os.path.join(view_image_dir, 'meta.ini'), 'w') as f:
-                f.write(mve_meta_template % (
-                camera.params[0] / max_dim, camera.params[2] / camera.width, camera.params[3] / camera.height,
-                R_str, T_str, new_image_id[image_id], image.name))
+    model = ColmapModel.read(sfm_colmap_dir, '.bin', cache=FLAGS.model_cache)
+    rotations = model.poses.R
+    translations = model.poses.t
+
+    # views are numbered by image id order
+    new_image_indices = image_indices(model)
+    order = np.argsort(new_image_indices)
+    camera_rows = model.image_camera_rows()[order]
+    LogThanExitIfFailed(np.all(model.camera_model_ids[camera_rows] == CAMERA_MODEL_NAMES['PINHOLE'].model_id),
+                        'mve scene needs undistorted PINHOLE cameras')
+    camera_params = model.camera_params[camera_rows]
+    assert np.all(np.abs(camera_params[:, 0] - camera_params[:, 1]) < 1e-8)
+    widths, heights = model.camera_widths[camera_rows], model.camera_heights[camera_rows]
+    max_dims = np.maximum(widths, heights)
+    intrinsics = np.zeros((model.num_images, 3))
+    intrinsics[:, 0] = camera_params[:, 0] / max_dims
+    bundler = BundlerArrays(
+        intrinsics=intrinsics, rotations=rotations[order], translations=translations[order],
+        xyzs=model.points3D_arrays.xyzs, rgbs=model.points3D_arrays.rgbs,
+        track_offsets=model.points3D_arrays.track_offsets,
+        track_image_ids=new_image_indices[model.track_image_rows()],
+        track_point2D_idxs=model.points3D_arrays.track_point2D_idxs)
 
+    num_threads = num_threads or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(num_threads) as executor:
+        futures = [executor.submit(write_bundler_arrays, bundler, os.path.join(mve_dir, 'synth_0.out'))]
+        for view_id, image_row in enumerate(order.tolist()):
+            name = model.images_arrays.names[image_row]
+            rotation = ''.join([' ' + str(v) for v in rotations[image_row].ravel().tolist()])
+            translation = ''.join([' ' + str(v) for v in translations[image_row].tolist()])
+            meta = MVE_META_TEMPLATE % (intrinsics[view_id, 0], camera_params[view_id, 2] / widths[view_id],
+                                        camera_params[view_id, 3] / heights[view_id],
+                                        rotation, translation, view_id, name)
+            futures.append(executor.submit(_write_mve_view, os.path.join(view_dir, 'view_%04d.mve' % view_id),
+                                           os.path.join(image_dir, name), meta, placement))
+        for future in futures:
+            future.result()
 
 if __name__ == '__main__':
     InitLogging()
@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import logging
+import operator
+import itertools
+import subprocess
+import numpy as np
+
+from pipeline.utils import LogThanExitIfFailed
+from third_party.colmap.read_write_model import Camera, ImagesArrays, Points3DArrays, rotmats2qvecs
+from pipeline.colmap_model import ColmapModel
+
+# cereal marks the first occurrence of a polymorphic type / shared pointer with this bit
+CEREAL_MSB = 0x80000000
+
+# openMVG intrinsic type: (COLMAP model, distortion field, params from focal length, principal point, distortion),
+# the same mapping as openMVG_main_openMVG2Colmap
+OPENMVG_CAMERA_MODELS = {
+    'pinhole': ('PINHOLE', None, lambda f, c, d: [f, f, c[0], c[1]]),
+    'pinhole_radial_k1': ('SIMPLE_RADIAL', 'disto_k1', lambda f, c, d: [f, c[0], c[1], d[0]]),
+    'pinhole_radial_k3': ('FULL_OPENCV', 'disto_k3',
+                          lambda f, c, d: [f, f, c[0], c[1], d[0], d[1], 0., 0., d[2], 0., 0., 0.]),
+    'pinhole_brown_t2': ('FULL_OPENCV', 'disto_t2',
+                         lambda f, c, d: [f, f, c[0], c[1], d[0], d[1], d[3], d[4], d[2], 0., 0., 0.]),
+    'fisheye': ('OPENCV_FISHEYE', 'fisheye', lambda f, c, d: [f, f, c[0], c[1], d[0], d[1], d[2], d[3]]),
+}
+
+
+def _read_polymorphic_map(entries):
+    """{key: (polymorphic type name, data)} of a cereal JSON map of polymorphic shared pointers.
+
+    The type name is only written with the first object of every type, and
+    the data only with the first reference to every pointer."""
+    type_names = {}
+    pointers = {}
+    result = {}
+    for entry in entries:
+        value = entry['value']
+        type_id = value['polymorphic_id']
+        if 'polymorphic_name' in value:
+            type_names[type_id & ~CEREAL_MSB] = value['polymorphic_name']
+        ptr_wrapper = value['ptr_wrapper']
+        if 'data' in ptr_wrapper:
+            pointers[ptr_wrapper['id'] & ~CEREAL_MSB] = ptr_wrapper['data']
+        result[entry['key']] = (type_names.get(type_id & ~CEREAL_MSB), pointers[ptr_wrapper['id'] & ~CEREAL_MSB])
+    return result
+
+
+def _view_name(root_path, view):
+    """Image name of an openMVG view: its path relative to root_path.
+
+    local_path is relative to root_path ('/' is root_path itself), or an
+    absolute directory for images outside of it.
+    """
+    local_path = view['local_path']
+    image_dir = root_path if local_path.strip('/') == '' else os.path.join(root_path, local_path)
+    return os.path.relpath(os.path.join(image_dir, view['filename']), root_path)
+
+
+def _float_rows(rows, row_size, count):
+    """(count, row_size) float64 array of an iterable of count number sequences."""
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64,
+                       count=count * row_size).reshape(count, row_size)
+
+
+def read_openmvg_sfm_data(filepath):
+    """ColmapModel of an openMVG sfm_data.json (views, intrinsics, extrinsics and structure).
+
+    Only the views with a pose are images of the model, camera and image ids
+    are the openMVG ids + 1 (COLMAP ids start at 1), image names are relative
+    to the sfm_data root_path, point ids are the landmark ids. The keypoints
+    of every image are its observations, ordered by landmark, so tracks and
+    keypoints refer to each other consistently.
+    openMVG does not store point colors or errors, they are left to 0.
+    """
+    with open(filepath, 'r') as f:
+        sfm_data = json.load(f)
+    missing = [section for section in ['views', 'intrinsics', 'extrinsics', 'structure'] if section not in sfm_data]
+    LogThanExitIfFailed(not missing, 'sfm_data %s has no %s', filepath, missing)
+
+    cameras = {}
+    for intrinsic_id, (type_name, data) in _read_polymorphic_map(sfm_data['intrinsics']).items():
+        LogThanExitIfFailed(type_name in OPENMVG_CAMERA_MODELS, 'unsupported openMVG intrinsic %s in %s',
+                            type_name, filepath)
+        model_name, distortion_field, params_fun = OPENMVG_CAMERA_MODELS[type_name]
+        params = params_fun(data['focal_length'], data['principal_point'],
+                            data[distortion_field] if distortion_field is not None else [])
+        cameras[intrinsic_id + 1] = Camera(id=intrinsic_id + 1, model=model_name, width=data['width'],
+                                           height=data['height'], params=np.array(params, dtype=np.float64))
+
+    extrinsics = dict([(entry['key'], entry['value']) for entry in sfm_data['extrinsics']])
+    views = [data for _, (_, data) in sorted(_read_polymorphic_map(sfm_data['views']).items())
+             if data['id_pose'] in extrinsics and data['id_intrinsic'] + 1 in cameras]
+    num_images = len(views)
+    image_ids = np.array([view['id_view'] + 1 for view in views], dtype=np.int64)
+    rotations = np.array([extrinsics[view['id_pose']]['rotation'] for view in views],
+                         dtype=np.float64).reshape(-1, 3, 3)
+    centers = np.array([extrinsics[view['id_pose']]['center'] for view in views], dtype=np.float64).reshape(-1, 3)
+
+    # the landmarks and observations are flattened with C level iterators, json.load is most of the time left
+    structure = sfm_data['structure']
+    num_points = len(structure)
+    landmarks = list(map(operator.itemgetter('value'), structure))
+    observations = list(map(operator.itemgetter('observations'), landmarks))
+    track_offsets = np.zeros(num_points + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, observations), dtype=np.int64, count=num_points), out=track_offsets[1:])
+    observations = list(itertools.chain.from_iterable(observations))
+    num_observations = len(observations)
+    obs_view_ids = np.fromiter(map(operator.itemgetter('key'), observations), dtype=np.int64, count=num_observations)
+    obs_xys = _float_rows(map(operator.itemgetter('x'), map(operator.itemgetter('value'), observations)), 2,
+                          num_observations)
+
+    # image row of every observation, in landmark order
+    view_rows = np.full(max([view['id_view'] for view in views] + obs_view_ids.tolist() + [-1]) + 1, -1,
+                        dtype=np.int64)
+    view_rows[image_ids - 1] = np.arange(num_images)
+    obs_image_rows = view_rows[obs_view_ids]
+    LogThanExitIfFailed(np.all(obs_image_rows >= 0), 'landmarks of %s are observed by views without pose', filepath)
+
+    # keypoints: the observations grouped by image, landmark order inside an image
+    order = np.argsort(obs_image_rows, kind='stable')
+    point2D_offsets = np.zeros(num_images + 1, dtype=np.int64)
+    np.cumsum(np.bincount(obs_image_rows, minlength=num_images), out=point2D_offsets[1:])
+    obs_point2D_idxs = np.empty(num_observations, dtype=np.int64)
+    obs_point2D_idxs[order] = np.arange(num_observations) - point2D_offsets[obs_image_rows[order]]
+    point3D_ids = np.fromiter(map(operator.itemgetter('key'), structure), dtype=np.int64, count=num_points)
+    obs_point_rows = np.repeat(np.arange(num_points), np.diff(track_offsets))
+
+    images_arrays = ImagesArrays(ids=image_ids,
+                                 qvecs=rotmats2qvecs(rotations) if num_images > 0 else np.empty((0, 4)),
+                                 tvecs=-np.einsum('nij,nj->ni', rotations, centers),
+                                 camera_ids=np.array([view['id_intrinsic'] + 1 for view in views], dtype=np.int64),
+                                 names=[_view_name(sfm_data['root_path'], view) for view in views],
+                                 point2D_offsets=point2D_offsets, xys=obs_xys[order],
+                                 point3D_ids=point3D_ids[obs_point_rows[order]])
+    points3D_arrays = Points3DArrays(ids=point3D_ids,
+                                     xyzs=_float_rows(map(operator.itemgetter('X'), landmarks), 3, num_points),
+                                     rgbs=np.zeros((num_points, 3), dtype=np.uint8), errors=np.zeros(num_points),
+                                     track_offsets=track_offsets, track_image_ids=image_ids[obs_image_rows],
+                                     track_point2D_idxs=obs_point2D_idxs)
+    return ColmapModel(cameras, images_arrays, points3D_arrays)
+
+
+def load_openmvg_sfm(sfm_openmvg_dir, work_dir):
+    """ColmapModel of the reconstruction of sfm_openmvg_dir.
+
+    Its sfm_data.json is read directly when it is not older than sfm_data.bin.
+    Otherwise the cereal binary layout of sfm_data.bin changes with the openMVG
+    version, so it is exported to work_dir/sfm_data.json with
+    openMVG_main_ConvertSfM_DataFormat first.
+    """
+    sfm_data_bin = os.path.join(sfm_openmvg_dir, 'sfm_data.bin')
+    sfm_data_json = os.path.join(sfm_openmvg_dir, 'sfm_data.json')
+    if not os.path.isfile(sfm_data_json) or \
+            (os.path.isfile(sfm_data_bin) and os.path.getmtime(sfm_data_json) < os.path.getmtime(sfm_data_bin)):
+        sfm_data_json = os.path.join(work_dir, 'sfm_data.json')
+        convert_command_line = ['openMVG_main_ConvertSfM_DataFormat',
+                                '-i', sfm_data_bin,
+                                '-o', sfm_data_json,
+                                '-V', '-I', '-E', '-S']
+        subprocess.run(convert_command_line, check=True)
+    model = read_openmvg_sfm_data(sfm_data_json)
+    logging.info('openMVG model %s: %d cameras, %d images, %d points', sfm_openmvg_dir, len(model.cameras),
+                 model.num_images, model.num_points3D)
+    return model
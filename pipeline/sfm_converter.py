@@ -3,12 +3,17 @@
 import logging
 import os
 import sys
-import pathlib
 import subprocess
 
-from pipeline.utils import InitLogging, GetFileFromBuildId, mvs_network_check
-from third_party.colmap.read_write_model import write_model, read_model, Camera, Image, Point3D
+from pipeline.utils import InitLogging, GetFileFromBuildId, LinkTree, mvs_network_check
 from pipeline.load_mve_sfm import load_mve_sfm, save_mve_sfm
+from pipeline.load_openmvg_sfm import load_openmvg_sfm
+from pipeline.colmap_model import model_digest
+from pipeline.artifact_store import ArtifactStore
+from pipeline.view_selection import DEFAULT_NUM_VIEWS, VIEW_SELECTION_VERSION, view_select, write_pair_txt, \
+    write_patch_match_cfg
+from pipeline.image_info import images_glob_pattern
+from pipeline.undistortion import undistort_colmap
 from pipeline.common_options import GLOBAL_OPTIONS as FLAGS
 from algorithm_wrapper.mvsnet_wrapper import export_colmap_to_mvsnet
 from algorithm_wrapper.pointmvsnet_wrapper import fix_mvsnet_to_pointmvsnet
@@ -28,67 +33,27 @@ def create_colmap_sparse_directory(base_dir):
 
 def sfm_colmap2colmap(in_colmap_dir, in_images_dir, out_colmap_dir, build_id: int = None):
     select_dir = GetFileFromBuildId(os.path.join(in_colmap_dir, 'sparse'), "*", build_id)
-    colmap_undistored_command_line = ['colmap', 'image_undistorter',
-                                      '--image_path', in_images_dir,
-                                      '--input_path', select_dir,
-                                      '--output_path', out_colmap_dir]
-    subprocess.run(colmap_undistored_command_line, check=True)
+    undistort_colmap(in_images_dir, select_dir, out_colmap_dir, num_threads=FLAGS.num_cpu,
+                     model_cache=FLAGS.model_cache)
     if FLAGS.converter_type in ['colmap', 'mvsnet']:
-        view_select_commandline = ['custom_view_select', os.path.join(out_colmap_dir, 'images'),
-                                   os.path.join(out_colmap_dir, 'sparse'), os.path.join(out_colmap_dir, 'stereo'),
-                                   '--alg', FLAGS.converter_type, '--selection_only']
-        if FLAGS.mvs_view_num is not None:
-            view_select_commandline.append('--num_view')
-            view_select_commandline.append(str(FLAGS.mvs_view_num))
-        subprocess.run(view_select_commandline, check=True)
-
-
-
-def fixed_openmvg_to_colmap_error(sfm_colmap_dir):
-    cameras, images, points3Ds = read_model(sfm_colmap_dir, '.txt')
-
-    points3Ds_count = {}
-    for track_id, track in points3Ds.items():
-        points3Ds_count[track_id] = 0
-
-    new_cameres = {}
-    for camera_id, camera in cameras.items():
-        new_cameres[camera_id + 1] = Camera(id=camera.id + 1, model=camera.model,
-                                            width=camera.width,
-                                            height=camera.height,
-                                            params=camera.params)
-    new_images = {}
-    for image_id, image in images.items():
-        for i in range(len(image.point3D_ids)):
-            pid = image.point3D_ids[i]
-            track = points3Ds[pid]
-            cnt = points3Ds_count[pid]
-            track.image_ids[cnt] = image_id + 1
-            track.point2D_idxs[cnt] = i
-            points3Ds_count[pid] = points3Ds_count[pid] + 1
-
-        new_images[image_id + 1] = Image(id=image.id + 1, qvec=image.qvec, tvec=image.tvec,
-                                         camera_id=image.camera_id + 1, name=image.name,
-                                         xys=image.xys,
-                                         point3D_ids=image.point3D_ids)
-    for track_id, track in points3Ds.items():
-        assert points3Ds_count[track_id] == len(track.point2D_idxs)
-
-    write_model(new_cameres, new_images, points3Ds, sfm_colmap_dir, '.bin')
-    write_model(new_cameres, new_images, points3Ds, sfm_colmap_dir, '.txt')
+        model, views = view_select(os.path.join(out_colmap_dir, 'sparse'), FLAGS.converter_type, FLAGS.mvs_view_num,
+                                   FLAGS.num_cpu)
+        write_pair_txt(os.path.join(out_colmap_dir, 'stereo', 'pair.txt'), model, views)
+        write_patch_match_cfg(os.path.join(out_colmap_dir, 'stereo', 'patch-match.cfg'), model, views)
+
 
 
 def sfm_mve2others(in_mve_dir, in_images_dir, out_others_dir, build_id: int = None, out_type='colmap'):
     assert build_id is None
     distorted_convert_dir = os.path.join(out_others_dir, 'tmp')
     tmp_work_dir = create_colmap_sparse_directory(distorted_convert_dir)
-    cameras, images, points3D = load_mve_sfm(in_mve_dir)
-    write_model(cameras, images, points3D, tmp_work_dir, '.txt')
+    model = load_mve_sfm(in_mve_dir)
+    model.write(tmp_work_dir, '.txt')
     original_images_dir = os.path.join(distorted_convert_dir, 'original_images')
     os.mkdir(original_images_dir)
-    for image_id, image in images.items():
+    for image_id, image_name in zip(model.images_arrays.ids.tolist(), model.images_arrays.names):
         original_image_path = os.path.join(in_mve_dir, 'view/views', 'view_%04d.mve' % image_id, 'original.jpg')
-        os.symlink(os.path.abspath(original_image_path), os.path.join(original_images_dir, image.name))
+        os.symlink(os.path.abspath(original_image_path), os.path.join(original_images_dir, image_name))
 
     sfm_convert_helper('colmap', out_type, distorted_convert_dir, original_images_dir, out_others_dir)
 
@@ -97,13 +62,7 @@ def sfm_openmvg2colmap(in_openmvg_dir, in_images_dir, out_colmap_dir, build_id:
     distorted_convert_dir = os.path.join(out_colmap_dir, 'tmp')
     tmp_work_dir = create_colmap_sparse_directory(distorted_convert_dir)
     assert build_id is None
-    openmvg_to_colmap_command_line = ['openMVG_main_openMVG2Colmap',
-                                      '--sfmdata', os.path.join(in_openmvg_dir, 'sfm_data.bin'),
-                                      '--outdir', tmp_work_dir]
-    subprocess.run(openmvg_to_colmap_command_line, check=True)
-    logging.info(
-        'there are errors with openMVG_main_openMVG2Colmap, the 3D->2D map partialily wrong, we can fix this')
-    fixed_openmvg_to_colmap_error(sfm_colmap_dir=tmp_work_dir)
+    load_openmvg_sfm(in_openmvg_dir, distorted_convert_dir).write(tmp_work_dir, '.bin')
     sfm_colmap2colmap(distorted_convert_dir, in_images_dir, out_colmap_dir)
 
 
@@ -183,13 +142,7 @@ def sfm_openmvg2pmvs(in_openmvg_dir, in_images_dir, out_openmvs_dir, build_id: i
 
 
 def sfm_theiasfm2pmvs(in_theiasfm_dir, in_images_dir, out_pmvs_dir, build_id: int = None):
-    tmp = pathlib.Path(in_images_dir)
-    images = None
-    for f in tmp.iterdir():
-        if f.suffix in ['.JPG', '.jpg', '.PNG', '.png'] and f.is_file():
-            images = '*' + f.suffix
-            break
-    assert isinstance(images, str)
+    images = images_glob_pattern(in_images_dir)
     select_file = GetFileFromBuildId(in_theiasfm_dir, "reconstruction.bin*", build_id)
     gen_pmvs_dir = os.path.join(out_pmvs_dir, 'pmvs')
     theiasfm2pmvs_command_line = ['export_reconstruction_to_pmvs',
@@ -237,23 +190,24 @@ def sfm_colmap2mvsnet(in_colmap_dir, in_images_dir, out_mvsnet_dir, build_id: in
         logging.warning('pair.txt already exist in folder %s, skip convert step',out_mvsnet_dir)
         return
     select_dir = GetFileFromBuildId(os.path.join(in_colmap_dir, 'sparse'), "*", build_id)
-    colmap_undistored_command_line = ['colmap', 'image_undistorter',
-                                      '--image_path', in_images_dir,
-                                      '--input_path', select_dir,
-                                      '--output_path', out_mvsnet_dir,
-                                      '--min_scale', '1.0',
-                                      '--max_scale', '1.0']
-    subprocess.run(colmap_undistored_command_line, check=True)
-    if FLAGS.converter_type in ['colmap', 'mvsnet']:
-        view_select_commandline = ['custom_view_select', os.path.join(out_mvsnet_dir, 'images'),
-                                   os.path.join(out_mvsnet_dir, 'sparse'), out_mvsnet_dir,
-                                   '--alg', FLAGS.converter_type]
-        if FLAGS.mvs_max_d is not None:
-            view_select_commandline.append('--max_d')
-            view_select_commandline.append(str(FLAGS.mvs_max_d))
-        subprocess.run(view_select_commandline, check=True)
-    else:
-        export_colmap_to_mvsnet(out_mvsnet_dir)
+    undistortion_options = {'blank_pixels': 0., 'min_scale': 1., 'max_scale': 1.}
+
+    def convert(output_dir):
+        undistort_colmap(in_images_dir, select_dir, output_dir, num_threads=FLAGS.num_cpu,
+                         model_cache=FLAGS.model_cache, **undistortion_options)
+        export_colmap_to_mvsnet(output_dir, 'colmap' if FLAGS.converter_type == 'colmap' else 'mvsnet')
+
+    if FLAGS.conversion_link == 'none':
+        convert(out_mvsnet_dir)
+        return
+    # every mvsnet like target of the workspace links the same conversion
+    ext = '.bin' if os.path.isfile(os.path.join(select_dir, 'images.bin')) else '.txt'
+    key = {'model': model_digest(select_dir, ext), 'images_dir': os.path.abspath(in_images_dir),
+           'undistortion': undistortion_options, 'mvs_max_d': FLAGS.mvs_max_d,
+           'mvs_view_num': FLAGS.mvs_view_num or DEFAULT_NUM_VIEWS, 'converter_type': FLAGS.converter_type,
+           'view_selection_version': VIEW_SELECTION_VERSION}
+    store = ArtifactStore(os.path.join(os.path.dirname(os.path.abspath(out_mvsnet_dir)), 'store'))
+    LinkTree(store.load_or_build_directory('colmap2mvsnet', key, convert), out_mvsnet_dir, FLAGS.conversion_link)
 
 
 def sfm_openmvg2mvsnet(in_openmvg_dir, in_images_dir, out_mvsnet_dir, build_id: int = None):
@@ -263,13 +217,7 @@ def sfm_openmvg2mvsnet(in_openmvg_dir, in_images_dir, out_mvsnet_dir, build_id:
     distorted_convert_dir = os.path.join(out_mvsnet_dir, 'tmp')
     tmp_work_dir = create_colmap_sparse_directory(distorted_convert_dir)
     assert build_id is None
-    openmvg_to_colmap_command_line = ['openMVG_main_openMVG2Colmap',
-                                      '--sfmdata', os.path.join(in_openmvg_dir, 'sfm_data.bin'),
-                                      '--outdir', tmp_work_dir]
-    subprocess.run(openmvg_to_colmap_command_line, check=True)
-    logging.info(
-        'there are errors with openMVG_main_openMVG2Colmap, the 3D->2D map partialily wrong, we can fix this')
-    fixed_openmvg_to_colmap_error(sfm_colmap_dir=tmp_work_dir)
+    load_openmvg_sfm(in_openmvg_dir, distorted_convert_dir).write(tmp_work_dir, '.bin')
     sfm_colmap2mvsnet(distorted_convert_dir, in_images_dir, out_mvsnet_dir, build_id)
 
 
@@ -11,6 +11,7 @@ import argparse
 import pathlib
 import logging
 from pipeline.common_options import GLOBAL_OPTIONS as FLAGS
+from pipeline.image_info import images_glob_pattern
 
 
 def sfm_colmap(images_dir, work_dir):
@@ -79,13 +80,7 @@ def sfm_openmvg(images_dir, work_dir):
 
 
 def sfm_theiasfm(options, images_dir, work_dir):
-    tmp = pathlib.Path(images_dir)
-    images = None
-    for f in tmp.iterdir():
-        if f.suffix in ['.JPG', '.jpg', '.PNG', '.png'] and f.is_file():
-            images = '*' + f.suffix
-            break
-    assert isinstance(images, str)
+    images = images_glob_pattern(images_dir, options.num_cpu)
 
     with open('data/build_reconstruction_flags.txt', 'r') as f:
         content = f.read()
@@ -0,0 +1,203 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+import numpy as np
+
+from pipeline.utils import LogThanExitIfFailed
+from pipeline.colmap_model import ColmapModel
+from pipeline.camera_models import CAMERA_MODEL_CLASSES, camera_from_colmap
+from third_party.colmap.read_write_model import Camera
+
+# remap maps of a 20MP image take about 120MB, most models have a single camera
+UNDISTORTION_MAP_CACHE_SIZE = 4
+UNDISTORTION_MANIFEST = 'undistortion.json'
+# the threads needing a map not in the cache wait for the one building it
+_undistortion_maps_lock = threading.Lock()
+
+
+def undistort_camera(camera, blank_pixels=0., min_scale=0.2, max_scale=2.):
+    """PINHOLE Camera undistorted from the read_write_model Camera camera.
+
+    Same rule as COLMAP's UndistortCamera (src/base/undistortion.cc): the
+    image borders are undistorted, the size is scaled so that blank_pixels = 0
+    leaves no blank pixel and blank_pixels = 1 keeps every source pixel, the
+    scale clipped to [min_scale, max_scale].
+    """
+    camera_model = camera_from_colmap(camera)
+    width, height = camera.width, camera.height
+    fx, fy, cx, cy = camera_model.fx, camera_model.fy, camera_model.cx, camera_model.cy
+    if not camera_model.has_distortion:
+        return Camera(id=camera.id, model='PINHOLE', width=width, height=height, params=np.array([fx, fy, cx, cy]))
+
+    ys = np.arange(height) + 0.5
+    xs = np.arange(width) + 0.5
+    left = camera_model.image_to_world(np.stack([np.full(height, 0.5), ys], axis=-1))[:, 0] * fx + cx
+    right = camera_model.image_to_world(np.stack([np.full(height, width - 0.5), ys], axis=-1))[:, 0] * fx + cx
+    top = camera_model.image_to_world(np.stack([xs, np.full(width, 0.5)], axis=-1))[:, 1] * fy + cy
+    bottom = camera_model.image_to_world(np.stack([xs, np.full(width, height - 0.5)], axis=-1))[:, 1] * fy + cy
+
+    # scale such that the undistorted image contains all pixels of the distorted image
+    min_scale_x = min(cx / (cx - left.min()), (width - 0.5 - cx) / (right.max() - cx))
+    min_scale_y = min(cy / (cy - top.min()), (height - 0.5 - cy) / (bottom.max() - cy))
+    # scale such that there are no blank pixels in the undistorted image
+    max_scale_x = max(cx / (cx - left.max()), (width - 0.5 - cx) / (right.min() - cx))
+    max_scale_y = max(cy / (cy - top.max()), (height - 0.5 - cy) / (bottom.min() - cy))
+    scale_x = np.clip(1. / (min_scale_x * blank_pixels + max_scale_x * (1. - blank_pixels)), min_scale, max_scale)
+    scale_y = np.clip(1. / (min_scale_y * blank_pixels + max_scale_y * (1. - blank_pixels)), min_scale, max_scale)
+
+    undistorted_width = int(max(1., scale_x * width))
+    undistorted_height = int(max(1., scale_y * height))
+    return Camera(id=camera.id, model='PINHOLE', width=undistorted_width, height=undistorted_height,
+                  params=np.array([fx, fy, cx * undistorted_width / width, cy * undistorted_height / height]))
+
+
+@functools.lru_cache(maxsize=UNDISTORTION_MAP_CACHE_SIZE)
+def undistortion_maps(model_name, params, width, height, undistorted_params, undistorted_width, undistorted_height):
+    """cv2.remap fixed point maps from the undistorted PINHOLE camera to the
+    distorted one, built once per distinct camera (arguments are hashable so
+    they key the LRU cache)."""
+    camera_model = CAMERA_MODEL_CLASSES[model_name](params, width, height)
+    fx, fy, cx, cy = undistorted_params
+    maps_x = np.empty((undistorted_height, undistorted_width), dtype=np.float32)
+    maps_y = np.empty((undistorted_height, undistorted_width), dtype=np.float32)
+    u = (np.arange(undistorted_width) + 0.5 - cx) / fx
+    # row blocks bound the float64 temporaries
+    rows_per_block = max(1, (1 << 20) // undistorted_width)
+    for begin in range(0, undistorted_height, rows_per_block):
+        end = min(begin + rows_per_block, undistorted_height)
+        v = (np.arange(begin, end) + 0.5 - cy) / fy
+        uv = np.stack(np.broadcast_arrays(u[None, :], v[:, None]), axis=-1)
+        xy = camera_model(uv)
+        # COLMAP samples pixel (x, y) at (x + 0.5, y + 0.5)
+        maps_x[begin:end] = xy[..., 0] - 0.5
+        maps_y[begin:end] = xy[..., 1] - 0.5
+    return cv2.convertMaps(maps_x, maps_y, cv2.CV_16SC2)
+
+
+def _camera_key(camera):
+    return (camera.model, tuple(np.asarray(camera.params, dtype=np.float64).tolist()), int(camera.width),
+            int(camera.height))
+
+
+def undistort_model(model, blank_pixels=0., min_scale=0.2, max_scale=2.):
+    """(undistorted ColmapModel, {camera_id: distorted Camera}): PINHOLE
+    cameras from undistort_camera and keypoints moved to them; points are kept."""
+    undistorted_cameras = dict([(camera_id, undistort_camera(camera, blank_pixels, min_scale, max_scale))
+                                for camera_id, camera in model.cameras.items()])
+    images_arrays = model.images_arrays
+    xys = np.array(images_arrays.xys, dtype=np.float64)
+    keypoint_camera_ids = np.repeat(images_arrays.camera_ids, np.diff(images_arrays.point2D_offsets))
+    for camera_id, camera in model.cameras.items():
+        selected = keypoint_camera_ids == camera_id
+        if not np.any(selected):
+            continue
+        uv = camera_from_colmap(camera).image_to_world(xys[selected])
+        fx, fy, cx, cy = undistorted_cameras[camera_id].params
+        xys[selected] = np.stack([uv[:, 0] * fx + cx, uv[:, 1] * fy + cy], axis=-1)
+    return ColmapModel(undistorted_cameras, images_arrays._replace(xys=xys), model.points3D_arrays), model.cameras
+
+
+def _undistort_image(image_path, output_path, camera, undistorted_camera):
+    if not CAMERA_MODEL_CLASSES[camera.model].has_distortion:
+        shutil.copyfile(image_path, output_path)
+        return
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    LogThanExitIfFailed(image is not None, 'can not read image %s', image_path)
+    with _undistortion_maps_lock:
+        maps = undistortion_maps(*_camera_key(camera), tuple(undistorted_camera.params.tolist()),
+                                 undistorted_camera.width, undistorted_camera.height)
+    undistorted = cv2.remap(image, maps[0], maps[1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    LogThanExitIfFailed(cv2.imwrite(output_path, undistorted, [cv2.IMWRITE_JPEG_QUALITY, 100]),
+                        'can not write image %s', output_path)
+
+
+def _image_key(image_path, camera, undistorted_camera):
+    stat = os.stat(image_path)
+    key = [stat.st_size, stat.st_mtime_ns, _camera_key(camera), _camera_key(undistorted_camera)]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+def undistort_images(model, cameras, image_dir, output_image_dir, manifest_path=None, num_threads=None,
+                     max_in_flight=None):
+    """Undistort the images of the undistorted model (see undistort_model,
+    cameras are the distorted ones) from image_dir into output_image_dir.
+
+    Images are remapped by a thread pool (cv2 releases the GIL) with at most
+    max_in_flight images decoded at a time. With manifest_path, images whose
+    source file and cameras did not change since the previous run are skipped.
+    """
+    num_threads = num_threads or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * num_threads
+    manifest = {}
+    if manifest_path is not None and os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    new_manifest = {}
+    tasks = []
+    for camera_id, name in zip(model.images_arrays.camera_ids.tolist(), model.images_arrays.names):
+        image_path = os.path.join(image_dir, name)
+        output_path = os.path.join(output_image_dir, name)
+        key = _image_key(image_path, cameras[camera_id], model.cameras[camera_id])
+        new_manifest[name] = key
+        if manifest.get(name) == key and os.path.isfile(output_path):
+            continue
+        tasks.append((image_path, output_path, cameras[camera_id], model.cameras[camera_id]))
+    logging.info('undistort %d images, %d unchanged ones skipped', len(tasks), model.num_images - len(tasks))
+    # images of one camera one after the other, so the map cache holds the maps in use
+    tasks.sort(key=lambda task: _camera_key(task[2]))
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        pending = set()
+        for image_path, output_path, camera, undistorted_camera in tasks:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            pending.add(executor.submit(_undistort_image, image_path, output_path, camera, undistorted_camera))
+        for future in pending:
+            future.result()
+
+    if manifest_path is not None:
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(new_manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def write_colmap_stereo_dir(stereo_dir, model):
+    """stereo/ of a COLMAP dense workspace, as image_undistorter writes it."""
+    for sub_dir in ['depth_maps', 'normal_maps', 'consistency_graphs']:
+        os.makedirs(os.path.join(stereo_dir, sub_dir), exist_ok=True)
+    names = [model.images_arrays.names[row] for row in np.argsort(model.images_arrays.ids, kind='stable').tolist()]
+    with open(os.path.join(stereo_dir, 'patch-match.cfg'), 'w') as f:
+        f.write(''.join(['%s\n__auto__, 20\n' % name for name in names]))
+    with open(os.path.join(stereo_dir, 'fusion.cfg'), 'w') as f:
+        f.write(''.join(['%s\n' % name for name in names]))
+
+
+def undistort_colmap(image_path, input_path, output_path, blank_pixels=0., min_scale=0.2, max_scale=2.,
+                     num_threads=None, model_cache=False):
+    """Python replacement of `colmap image_undistorter --output_type COLMAP`:
+    output_path gets images/, sparse/ (binary, PINHOLE cameras) and stereo/.
+    Reruns only undistort the images that changed. Returns the undistorted model."""
+    ext = '.bin' if os.path.isfile(os.path.join(input_path, 'images.bin')) else '.txt'
+    model, cameras = undistort_model(ColmapModel.read(input_path, ext, cache=model_cache),
+                                     blank_pixels, min_scale, max_scale)
+    sparse_dir = os.path.join(output_path, 'sparse')
+    os.makedirs(sparse_dir, exist_ok=True)
+    os.makedirs(os.path.join(output_path, 'images'), exist_ok=True)
+    undistort_images(model, cameras, image_path, os.path.join(output_path, 'images'),
+                     os.path.join(output_path, UNDISTORTION_MANIFEST), num_threads)
+    model.write(sparse_dir, '.bin')
+    write_colmap_stereo_dir(os.path.join(output_path, 'stereo'), model)
+    return model
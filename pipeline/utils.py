@@ -3,6 +3,8 @@
 import subprocess
 from csv import DictReader
 import os
+import shutil
+import fcntl
 import argparse
 import logging
 import pathlib
@@ -58,6 +60,58 @@ def GetFileFromBuildId(file_dir:str, pattern:str, build_id:int = None):
                             file_dir, pattern, build_id, file_selected)
         return str(file_selected[0].absolute().as_posix())
 
+# linux FICLONE ioctl, share the data blocks of two files on btrfs / xfs
+FICLONE = 0x40049409
+
+
+def PlaceFile(src:str, dst:str, mode:str = 'move'):
+    """Put src at dst: move (rename), symlink, hardlink, reflink or copy.
+    hardlink and reflink fall back to a copy when the filesystem can not do them."""
+    if mode == 'move':
+        os.rename(src, dst)
+        return
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            logging.debug('can not hardlink %s to %s (%s), copy it', src, dst, e)
+    elif mode == 'reflink':
+        try:
+            with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError as e:
+            logging.debug('can not reflink %s to %s (%s), copy it', src, dst, e)
+    else:
+        LogThanExitIfFailed(mode == 'copy', 'unknown file placement mode: %s', mode)
+    shutil.copy2(src, dst)
+
+
+def LinkTree(src_dir:str, dst_dir:str, mode:str = 'hardlink'):
+    """Recreate the directories of src_dir in dst_dir and place every file with
+    PlaceFile (hardlink or symlink); writing new files in dst_dir never
+    touches src_dir. The placed files share their data with src_dir, rewrite
+    one only after DetachFile."""
+    for root, dirs, files in os.walk(src_dir):
+        dst_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(dst_root, exist_ok=True)
+        for name in files:
+            PlaceFile(os.path.join(root, name), os.path.join(dst_root, name), mode)
+
+
+def DetachFile(path:str):
+    """Remove path if it is a symlink or a hardlink shared with other paths (as
+    placed by LinkTree), so that writing path next creates a file of its own
+    instead of writing through to the shared one."""
+    if os.path.islink(path) or (os.path.isfile(path) and os.stat(path).st_nlink > 1):
+        os.unlink(path)
+
+
 def mvs_network_check(mvs_alg:str):
     if mvs_alg in ['mvsnet', 'rmvsnet']:
         mvsnet_path = get_mvsnet_path()
@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import math
+import logging
+import multiprocessing as mp
+import numpy as np
+
+from pipeline.utils import LogThanExitIfFailed
+from pipeline.colmap_model import ColmapModel
+from pipeline.covisibility import CovisibilityIndex
+
+DEFAULT_NUM_VIEWS = 10
+# bumped whenever the selected views of the same model change, it is part of the stored conversion keys
+VIEW_SELECTION_VERSION = 2
+
+# (covisibility, method) of the running compute_pair_scores, set in every pool worker by its initializer
+_pair_scores_state = None
+
+
+def _init_pair_scores_state(covisibility, method):
+    global _pair_scores_state
+    _pair_scores_state = (covisibility, method)
+
+
+def mvsnet_scores(angles, entry_pairs, num_pairs, theta0=5., sigma1=1., sigma2=10.):
+    """MVSNet view selection score of every pair: sum over the shared points of a
+    Gaussian kernel of the triangulation angle (degrees) centered on theta0.
+
+    colmap2mvsnet.py scores the unfolded angle in [0, 180], so the pair scores
+    use triangulation_angles(fold=False), the statistics of
+    eval/compute_sfm_statistics.py keep the folded angle they always used."""
+    angles = 180. * angles / math.pi
+    kernel = np.where(angles < theta0, (angles - theta0) / sigma1, (angles - theta0) / sigma2)
+    return np.bincount(entry_pairs, weights=np.exp(-kernel * kernel / 2), minlength=num_pairs)
+
+
+def colmap_scores(angles, entry_pairs, num_pairs, min_num_shared=100, min_angle=1.):
+    """COLMAP style score of every pair: the number of shared points if there are
+    at least min_num_shared and their 75th percentile triangulation angle is at
+    least min_angle degrees, 0 otherwise. entry_pairs must be sorted."""
+    num_shared = np.bincount(entry_pairs, minlength=num_pairs)
+    offsets = np.zeros(num_pairs + 1, dtype=np.int64)
+    np.cumsum(num_shared, out=offsets[1:])
+    sorted_angles = angles[np.lexsort((angles, entry_pairs))]
+    valid = num_shared >= min_num_shared
+    percentile = np.round(75 * num_shared[valid] / 100).astype(np.int64)
+    pair_angles = np.zeros(num_pairs)
+    pair_angles[valid] = sorted_angles[offsets[:-1][valid] + percentile]
+    return np.where(valid & (pair_angles >= (min_angle * math.pi / 180.)), num_shared, 0)
+
+
+SCORE_FUNCTIONS = {'mvsnet': mvsnet_scores, 'colmap': colmap_scores}
+
+
+def _pair_scores_chunk(bounds):
+    covisibility, method = _pair_scores_state
+    begin, end = bounds
+    angles = covisibility.triangulation_angles(begin=begin, end=end, fold=method != 'mvsnet')
+    entry_pairs = np.repeat(np.arange(end - begin), covisibility.num_shared[begin:end])
+    return SCORE_FUNCTIONS[method](angles, entry_pairs, end - begin)
+
+
+def compute_pair_scores(covisibility, method='mvsnet', num_processes=1, chunk_size=1 << 20):
+    """Score of every covisible pair of covisibility, see SCORE_FUNCTIONS.
+
+    Pairs are scored in chunks of about chunk_size shared points, in
+    num_processes worker processes.
+    """
+    global _pair_scores_state
+    LogThanExitIfFailed(method in SCORE_FUNCTIONS, 'unknown view selection method: %s', method)
+    covisibility.model.poses  # build the pose table once, before it is sent to the workers
+
+    # cut the pairs so that every chunk has about chunk_size shared points
+    cuts = np.searchsorted(covisibility.pair_offsets, np.arange(0, covisibility.pair_offsets[-1], chunk_size))
+    cuts = np.unique(np.append(np.minimum(cuts, covisibility.num_pairs), covisibility.num_pairs))
+    chunks = [(begin, end) for begin, end in zip([0] + cuts[:-1].tolist(), cuts.tolist()) if end > begin]
+
+    _pair_scores_state = (covisibility, method)
+    try:
+        if num_processes > 1 and len(chunks) > 1:
+            with mp.Pool(min(num_processes, len(chunks)), initializer=_init_pair_scores_state,
+                         initargs=(covisibility, method)) as pool:
+                results = pool.map(_pair_scores_chunk, chunks)
+        else:
+            results = [_pair_scores_chunk(chunk) for chunk in chunks]
+    finally:
+        _pair_scores_state = None
+    return np.concatenate(results).astype(np.float64) if results else np.empty(0)
+
+
+def select_views(covisibility, pair_scores, num_views=DEFAULT_NUM_VIEWS):
+    """For every image row, the (image rows, scores) of its num_views best
+    scored neighbors, best first. Ties keep the lower image row first.
+
+    Like colmap2mvsnet.py, an image with fewer than num_views neighbors is
+    padded with the other images at score 0, so every row has num_views views
+    (or all the other images if there are fewer)."""
+    num_images = covisibility.model.num_images
+    views = []
+    for image_row in range(num_images):
+        neighbor_rows, pairs = covisibility.neighbors(image_row)
+        scores = pair_scores[pairs]
+        if len(neighbor_rows) < min(num_views, num_images - 1):
+            row_scores = np.zeros(num_images)
+            row_scores[neighbor_rows] = scores
+            neighbor_rows = np.delete(np.arange(num_images), image_row)
+            scores = row_scores[neighbor_rows]
+        order = np.lexsort((neighbor_rows, -scores))[:num_views]
+        views.append((neighbor_rows[order], scores[order]))
+    return views
+
+
+def image_indices(model):
+    """MVSNet index (rank of the image id) of every image row."""
+    indices = np.empty(model.num_images, dtype=np.int64)
+    indices[np.argsort(model.images_arrays.ids, kind='stable')] = np.arange(model.num_images)
+    return indices
+
+
+def write_pair_txt(path, model, views):
+    """pair.txt in the MVSNet format, images indexed by image_indices."""
+    indices = image_indices(model)
+    with open(path, 'w') as f:
+        f.write('%d\n' % len(views))
+        for image_row in np.argsort(indices).tolist():
+            neighbor_rows, scores = views[image_row]
+            f.write('%d\n%d ' % (indices[image_row], len(neighbor_rows)))
+            for neighbor_index, score in zip(indices[neighbor_rows].tolist(), scores.tolist()):
+                f.write('%d %f ' % (neighbor_index, score))
+            f.write('\n')
+
+
+def write_patch_match_cfg(path, model, views):
+    """COLMAP stereo patch-match.cfg listing the selected source images of every image."""
+    names = model.images_arrays.names
+    with open(path, 'w') as f:
+        for image_row in np.argsort(image_indices(model)).tolist():
+            neighbor_rows, _ = views[image_row]
+            f.write('%s\n%s\n' % (names[image_row], ', '.join(names[row] for row in neighbor_rows.tolist())))
+
+
+def view_select(sparse_dir, method='mvsnet', num_views=None, num_processes=1, model=None):
+    """Score all covisible pairs of the model in sparse_dir and select the
+    num_views best source views of every image. Returns (model, views), views
+    indexed by image row, see select_views."""
+    if model is None:
+        ext = '.bin' if os.path.isfile(os.path.join(sparse_dir, 'images.bin')) else '.txt'
+        model = ColmapModel.read(sparse_dir, ext)
+    covisibility = CovisibilityIndex.from_model(model)
+    logging.info('view selection (%s): %d images, %d covisible pairs', method, model.num_images,
+                 covisibility.num_pairs)
+    pair_scores = compute_pair_scores(covisibility, method, num_processes)
+    return model, select_views(covisibility, pair_scores, num_views or DEFAULT_NUM_VIEWS)